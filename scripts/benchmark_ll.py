@@ -264,24 +264,12 @@ radius_from_knots = np.repeat(radius, k) # influence radius from a knot
 
 # Generate the weight matrices
 # Weight matrix generated using Gaussian Smoothing Kernel
-gaussian_weight_matrix = np.full(shape = (Ns, k), fill_value = np.nan)
-for site_id in np.arange(Ns):
-    # Compute distance between each pair of the two collections of inputs
-    d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                    XB = knots_xy)
-    # influence coming from each of the knots
-    weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-    gaussian_weight_matrix[site_id, :] = weight_from_knots
+gaussian_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'gaussian',
+                                       radius = radius, bandwidth = bandwidth, cutoff = False)
 
 # Weight matrix generated using wendland basis
-wendland_weight_matrix = np.full(shape = (Ns,k), fill_value = np.nan)
-for site_id in np.arange(Ns):
-    # Compute distance between each pair of the two collections of inputs
-    d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                    XB = knots_xy)
-    # influence coming from each of the knots
-    weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-    wendland_weight_matrix[site_id, :] = weight_from_knots
+wendland_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'wendland',
+                                       radius = radius_from_knots)
 
 # Covariance K for Gaussian Field g(Z) 
 nu = 0.5 # exponential kernel for matern with nu = 1/2
@@ -466,8 +454,12 @@ lb = 0.5
 ub = 1.5
 grids = 5
 rho_grid = np.linspace(lb, ub, grids)
+# all the covariances of the sweep at once, sharing the pairwise geometry
+range_mat = np.array([gaussian_weight_matrix @ np.array([rho_x] * k) for rho_x in rho_grid])
+K_stack   = ns_cov(range_vec = range_mat,
+                   sigsq_vec = sigsq_vec, coords = sites_xy, kappa = nu, cov_model = 'matern')
 ll_rho = []
-for rho_x in rho_grid:
+for rho_idx, rho_x in enumerate(rho_grid):
     args_list = []
     for t in range(Nt):
         # marginal process
@@ -485,9 +477,7 @@ for rho_x in rho_grid:
         Z_1t      = Z[:,t]
         phi_vec   = gaussian_weight_matrix @ phi_at_knots
         tau       = 10
-        range_vec = gaussian_weight_matrix @ np.array([rho_x] * k)
-        K         = ns_cov(range_vec = range_vec,
-                        sigsq_vec = sigsq_vec, coords = sites_xy, kappa = nu, cov_model = 'matern')
+        K         = K_stack[rho_idx]
 
         X_1t      = None
         X_star_1t = None
@@ -0,0 +1,63 @@
+# log-density kernels for the sampler's hot path
+# closed forms on whole arrays, from scipy.special primitives (log_ndtr, xlogy, ...),
+# without the argument checking and dispatch of scipy.stats distributions, which
+# dominates for vectors of a few hundred elements. They agree with the scipy.stats
+# calls they replace to 1e-12 (relative, max(1, |value|)) on the support, and give -inf
+# off it, as checked by test_kernels.py.
+# %%
+# general imports
+import numpy as np
+import scipy.special as sc
+
+LOG_2PI = np.log(2*np.pi)
+
+# %% Normal
+# scipy.stats.norm.logpdf(x, loc, scale)
+def norm_logpdf(x, loc = 0.0, scale = 1.0):
+    z = (x - loc) / scale
+    return -0.5 * z**2 - np.log(scale) - 0.5 * LOG_2PI
+
+# scipy.stats.norm.logcdf(x, loc, scale)
+def norm_logcdf(x, loc = 0.0, scale = 1.0):
+    return sc.log_ndtr((x - loc) / scale)
+
+# %% Generalized Pareto
+# scipy.stats.genpareto.logpdf(y, c = shape, loc = loc, scale = scale)
+def genpareto_logpdf(y, loc, scale, shape):
+    z, shape = np.broadcast_arrays((y - loc) / scale, shape)
+    safe     = np.where(shape == 0, 1.0, shape) # avoid 1/0, the shape == 0 branch is exponential
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ll = np.where(shape == 0, -z, -sc.xlog1py(1 + 1/safe, safe * z)) - np.log(scale)
+    in_support = (z >= 0) & ((shape >= 0) | (z <= -1/safe))
+    return np.where(in_support, ll, -np.inf)
+
+# log of dCGP(y, p, loc, scale, shape); -inf at and below the threshold loc
+def cgp_logpdf(y, p, loc, scale, shape):
+    return np.where(y <= loc, -np.inf, np.log(1-p) + genpareto_logpdf(y, loc, scale, shape))
+
+# %% Priors
+# scipy.stats.levy.logpdf(x, loc, scale)
+def levy_logpdf(x, loc = 0.0, scale = 1.0):
+    y = np.asarray(x - loc, dtype = 'float64')
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ll = 0.5 * np.log(scale / (2*np.pi)) - 1.5 * np.log(y) - scale / (2*y)
+    return np.where(y > 0, ll, -np.inf)
+
+# scipy.stats.beta.logpdf(x, a, b)
+def beta_logpdf(x, a, b):
+    x = np.asarray(x, dtype = 'float64')
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ll = sc.xlogy(a - 1, x) + sc.xlog1py(b - 1, -x) - sc.betaln(a, b)
+    return np.where((x >= 0) & (x <= 1), ll, -np.inf)
+
+# scipy.stats.halfnorm.logpdf(x, loc, scale)
+def halfnorm_logpdf(x, loc = 0.0, scale = 1.0):
+    z = np.asarray((x - loc) / scale, dtype = 'float64')
+    return np.where(z >= 0, 0.5 * np.log(2/np.pi) - 0.5 * z**2 - np.log(scale), -np.inf)
+
+# np.log(dhalft(y, nu, mu, sigma)), the half-t with nu degrees of freedom
+def halft_logpdf(y, nu, mu = 0.0, sigma = 1.0):
+    z  = np.asarray((y - mu) / sigma, dtype = 'float64')
+    ll = np.log(2) + sc.gammaln((nu + 1)/2) - sc.gammaln(nu/2) - 0.5 * np.log(nu * np.pi) - np.log(sigma) \
+         - (nu + 1)/2 * np.log1p(z**2 / nu)
+    return np.where(z >= 0, ll, -np.inf)
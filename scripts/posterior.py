@@ -42,6 +42,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy
 import time
+import pickle
 from mpi4py import MPI
 from time import strftime, localtime
 from utilities import *
@@ -354,24 +355,12 @@ radius_from_knots = np.repeat(radius, k) # influence radius from a knot
 
 # Generate the weight matrices
 # Weight matrix generated using Gaussian Smoothing Kernel
-gaussian_weight_matrix = np.full(shape = (Ns, k), fill_value = np.nan)
-for site_id in np.arange(Ns):
-    # Compute distance between each pair of the two collections of inputs
-    d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                    XB = knots_xy)
-    # influence coming from each of the knots
-    weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-    gaussian_weight_matrix[site_id, :] = weight_from_knots
+gaussian_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'gaussian',
+                                       radius = radius, bandwidth = bandwidth, cutoff = False)
 
 # Weight matrix generated using wendland basis
-wendland_weight_matrix = np.full(shape = (Ns,k), fill_value = np.nan)
-for site_id in np.arange(Ns):
-    # Compute distance between each pair of the two collections of inputs
-    d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                    XB = knots_xy)
-    # influence coming from each of the knots
-    weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-    wendland_weight_matrix[site_id, :] = weight_from_knots
+wendland_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'wendland',
+                                       radius = radius_from_knots)
 
 # # constant weight matrix
 # constant_weight_matrix = np.full(shape = (Ns, k), fill_value = np.nan)
@@ -546,24 +535,12 @@ radius_from_knots = np.repeat(radius, k) # ?influence radius from a knot?
 assert k == len(knots_xy)
 
 # Weight matrix generated using Gaussian Smoothing Kernel
-gaussian_weight_matrix = np.full(shape = (Ns, k), fill_value = np.nan)
-for site_id in np.arange(Ns):
-    # Compute distance between each pair of the two collections of inputs
-    d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                    XB = knots_xy)
-    # influence coming from each of the knots
-    weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-    gaussian_weight_matrix[site_id, :] = weight_from_knots
+gaussian_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'gaussian',
+                                       radius = radius, bandwidth = bandwidth, cutoff = False)
 
 # Weight matrix generated using wendland basis
-wendland_weight_matrix = np.full(shape = (Ns,k), fill_value = np.nan)
-for site_id in np.arange(Ns):
-    # Compute distance between each pair of the two collections of inputs
-    d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                    XB = knots_xy)
-    # influence coming from each of the knots
-    weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-    wendland_weight_matrix[site_id, :] = weight_from_knots
+wendland_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'wendland',
+                                       radius = radius_from_knots)
 
 # ----------------------------------------------------------------------------------------------------------------
 # Setup For the Marginal Model - GEV(mu, sigma, ksi)
@@ -756,28 +733,24 @@ plotgrid_y = np.linspace(minY,maxY,plotgrid_res_y)
 plotgrid_X, plotgrid_Y = np.meshgrid(plotgrid_x, plotgrid_y)
 plotgrid_xy = np.vstack([plotgrid_X.ravel(), plotgrid_Y.ravel()]).T
 
-gaussian_weight_matrix_for_plot = np.full(shape = (plotgrid_res_xy, k), fill_value = np.nan)
-for site_id in np.arange(plotgrid_res_xy):
-    # Compute distance between each pair of the two collections of inputs
-    d_from_knots = scipy.spatial.distance.cdist(XA = plotgrid_xy[site_id,:].reshape((-1,2)), 
-                                    XB = knots_xy)
-    # influence coming from each of the knots
-    weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-    gaussian_weight_matrix_for_plot[site_id, :] = weight_from_knots
-
-wendland_weight_matrix_for_plot = np.full(shape = (plotgrid_res_xy,k), fill_value = np.nan)
-for site_id in np.arange(plotgrid_res_xy):
-    # Compute distance between each pair of the two collections of inputs
-    d_from_knots = scipy.spatial.distance.cdist(XA = plotgrid_xy[site_id,:].reshape((-1,2)), 
-                                    XB = knots_xy)
-    # influence coming from each of the knots
-    weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-    wendland_weight_matrix_for_plot[site_id, :] = weight_from_knots
+gaussian_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'gaussian',
+                                                radius = radius, bandwidth = bandwidth, cutoff = False)
+
+# phi uses the Gaussian weights truncated at the run's phi_weight_tol (None for runs without it)
+if os.path.exists(folder + 'phi_weight_tol.pkl'):
+    with open(folder + 'phi_weight_tol.pkl', 'rb') as file: phi_weight_tol = pickle.load(file)
+else:
+    phi_weight_tol = None
+phi_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'gaussian',
+                                           radius = radius, bandwidth = bandwidth, cutoff = False, tol = phi_weight_tol)
+
+wendland_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'wendland',
+                                                radius = radius_from_knots)
 
 # 3. phi surface
 
 # heatplot of phi surface
-phi_vec_for_plot = gaussian_weight_matrix_for_plot @ phi_mean
+phi_vec_for_plot = phi_weight_matrix_for_plot @ phi_mean
 graph, ax = plt.subplots()
 heatmap = ax.imshow(phi_vec_for_plot.reshape(plotgrid_res_y,plotgrid_res_x), 
                     cmap ='bwr', interpolation='nearest', extent = [minX, maxX, maxY, minY])
@@ -785,7 +758,7 @@ ax.invert_yaxis()
 graph.colorbar(heatmap)
 plt.show()
 
-phi_vec_for_plot = gaussian_weight_matrix_for_plot @ phi_mean
+phi_vec_for_plot = phi_weight_matrix_for_plot @ phi_mean
 fig, ax = plt.subplots()
 state_map.boundary.plot(ax=ax, color = 'black')
 heatmap = ax.imshow(phi_vec_for_plot.reshape(plotgrid_res_y,plotgrid_res_x), 
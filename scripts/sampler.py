@@ -26,6 +26,7 @@ if __name__ == "__main__":
     import scipy
     from mpi4py import MPI
     from utilities import *
+    import kernels
     import gstools as gs
     import rpy2.robjects as robjects
     from rpy2.robjects import r 
@@ -41,6 +42,13 @@ if __name__ == "__main__":
     rank = comm.Get_rank()
     size = comm.Get_size()
     random_generator = np.random.RandomState((rank+1)*7)
+
+    # Keep one copy per node of the large read-only arrays (data, design and basis
+    # matrices, the covariance K and its factor) in MPI-3 shared memory
+    use_shared_memory = True
+    node_shared       = NodeShared(comm) if use_shared_memory else None
+    def node_array(data):
+        return node_shared.array(data) if node_shared is not None else np.array(data)
     
     try:
         data_seed
@@ -68,7 +76,7 @@ if __name__ == "__main__":
     # %% Load Simulated Dataset ---------------------------------------------------------------------------------------
 
     datafolder         = 'stationary_seed2345_t32_s500_phi0.7_rho1.0/'
-    Y                  = np.load('./data/'+datafolder+'Y.npy')
+    Y                  = node_array(np.load('./data/'+datafolder+'Y.npy', mmap_mode = 'r'))
     logsigma_estimates = np.load('./data/'+datafolder+'logsigma_matrix.npy')[:,0]
     ksi_estimates      = np.load('./data/'+datafolder+'ksi_matrix.npy')[:,0]
     stations           = np.load('./data/'+datafolder+'sites_xy.npy')
@@ -143,24 +151,25 @@ if __name__ == "__main__":
 
     # Generate the weight matrices
     # Weight matrix generated using Gaussian Smoothing Kernel
-    gaussian_weight_matrix = np.full(shape = (Ns, k), fill_value = np.nan)
-    for site_id in np.arange(Ns):
-        # Compute distance between each pair of the two collections of inputs
-        d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                        XB = knots_xy)
-        # influence coming from each of the knots
-        weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-        gaussian_weight_matrix[site_id, :] = weight_from_knots
+    gaussian_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'gaussian',
+                                           radius = radius, bandwidth = bandwidth, cutoff = False)
+    gaussian_weight_matrix = node_array(gaussian_weight_matrix)
+
+    # Weight matrix for phi, the Gaussian kernel truncated at phi_weight_tol (range keeps the full one)
+    # phi_weight_tol = None --> every phi knot reaches every site; e.g. 1e-6 --> weights below it
+    # are dropped, so a phi block only recomputes X, dX and the likelihood on its knots' supports
+    phi_weight_tol    = None
+    phi_weight_matrix = gaussian_weight_matrix
+    if phi_weight_tol is not None:
+        phi_weight_matrix = node_array(weight_matrix(sites_xy, knots_xy, basis = 'gaussian',
+                                                     radius = radius, bandwidth = bandwidth, cutoff = False, tol = phi_weight_tol))
+    phi_weight_csc    = scipy.sparse.csc_matrix(phi_weight_matrix) # per-knot support for phi updates
 
     # Weight matrix generated using wendland basis
-    wendland_weight_matrix = np.full(shape = (Ns,k), fill_value = np.nan)
-    for site_id in np.arange(Ns):
-        # Compute distance between each pair of the two collections of inputs
-        d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                        XB = knots_xy)
-        # influence coming from each of the knots
-        weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-        wendland_weight_matrix[site_id, :] = weight_from_knots
+    wendland_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'wendland',
+                                           radius = radius_from_knots)
+    wendland_weight_matrix = node_array(wendland_weight_matrix)
+    wendland_weight_csc    = scipy.sparse.csc_matrix(wendland_weight_matrix) # per-knot support for S updates
     
     # Marginal Model - GP(sigma, ksi) threshold u ---------------------------------------------------------------------
     
@@ -169,12 +178,14 @@ if __name__ == "__main__":
     C_logsigma        = np.full(shape = (Beta_logsigma_m, Ns, Nt), fill_value = np.nan)
     C_logsigma[0,:,:] = 1.0 
     C_logsigma[1,:,:] = np.tile(elevations, reps = (Nt, 1)).T
+    C_logsigma        = node_array(C_logsigma)
 
     # Shape ksi(s)
     Beta_ksi_m   = 2 # just intercept and elevation
     C_ksi        = np.full(shape = (Beta_ksi_m, Ns, Nt), fill_value = np.nan) # ksi design matrix
     C_ksi[0,:,:] = 1.0
     C_ksi[1,:,:] = np.tile(elevations, reps = (Nt, 1)).T
+    C_ksi        = node_array(C_ksi)
 
     # Setup For the Copula/Data Model - X = e + X_star = R^phi * g(Z) -------------------------------------------------
 
@@ -183,6 +194,68 @@ if __name__ == "__main__":
     sigsq = 1.0 # sill for Z
     sigsq_vec = np.repeat(sigsq, Ns) # hold at 1
 
+    # Gaussian log-density of Z: exact ('dense'), nearest-neighbour conditioning ('vecchia'),
+    # or low-rank through a set of knots ('predictive_process')
+    # make_Z_field(range_knots) builds the field for a given set of range knots, on rank 0
+    gauss_ll_method = 'dense'
+    vecchia_m       = 30       # number of conditioning neighbours
+    vecchia_order   = 'maxmin' # ordering of the sites: 'maxmin', 'coord', or 'none'
+    pp_grid_size    = None     # predictive-process knots: None --> knots_xy, n --> n x n grid over the domain
+    # Z sweep: 'sitewise' --> one site at a time; 'coloured' --> all sites of one colour of the
+    # precision graph at once (useful with 'vecchia', whose Q is sparse; dense Q gives Ns colours);
+    # 'ess' --> elliptical slice sampling of the whole Z_1t under N(0, K), no tuning needed
+    Z_update        = 'sitewise'
+    # log S and Z: 'mh' --> the single-site moves above; 'mala' --> mala_steps joint MALA steps
+    # on (log S_t, Z_t) per iteration, with adapted step size and diagonal mass matrix
+    S_Z_update      = 'mh'
+    mala_steps      = 3
+    if gauss_ll_method == 'vecchia':
+        vecchia_order_idx, vecchia_nn = vecchia_neighbors(sites_xy, m = vecchia_m, ordering = vecchia_order)
+        # only the neighbour blocks of K are built, never the Ns x Ns matrix
+        make_Z_field = lambda range_knots: VecchiaGaussianField(ns_cov_blocks(gaussian_weight_matrix @ range_knots, sigsq_vec, sites_xy,
+                                                                              kappa = nu, cov_model = "matern"),
+                                                                vecchia_order_idx, vecchia_nn)
+    elif gauss_ll_method == 'predictive_process':
+        if pp_grid_size is None:
+            pp_knots_xy = knots_xy
+        else:
+            pp_X, pp_Y  = np.meshgrid(np.linspace(minX, maxX, pp_grid_size), np.linspace(minY, maxY, pp_grid_size))
+            pp_knots_xy = np.vstack([pp_X.ravel(), pp_Y.ravel()]).T
+        # range surface at the predictive-process knots, from the same Gaussian basis as at the sites
+        pp_weight_matrix = weight_matrix(pp_knots_xy, knots_xy, basis = 'gaussian',
+                                         radius = radius, bandwidth = bandwidth, cutoff = False)
+        pp_sigsq_vec     = np.repeat(sigsq, len(pp_knots_xy))
+        def make_Z_field(range_knots):
+            range_vec    = gaussian_weight_matrix @ range_knots
+            pp_range_vec = pp_weight_matrix @ range_knots
+            return PredictiveProcessField(ns_cov(range_vec = pp_range_vec, sigsq_vec = pp_sigsq_vec,
+                                                 coords = pp_knots_xy, kappa = nu, cov_model = "matern"),
+                                          ns_cov_cross(pp_range_vec, pp_sigsq_vec, pp_knots_xy, 
+                                                       range_vec, sigsq_vec, sites_xy, kappa = nu, cov_model = "matern"),
+                                          sigsq_vec**2)
+    else:
+        make_Z_field = lambda range_knots: GaussianField(ns_cov(range_vec = gaussian_weight_matrix @ range_knots,
+                                                                sigsq_vec = sigsq_vec, coords = sites_xy, kappa = nu, cov_model = "matern"),
+                                                         precision = True) # Q for the one-site Z moves
+
+    # make_Z_fields(range_knots_stack) builds the fields of M stacked range knots, on rank 0, for
+    # the multi-proposal range update; the dense covariances are built in one ns_cov_batch pass.
+    # None where K is not positive definite
+    def make_Z_fields(range_knots_stack):
+        if gauss_ll_method != 'dense':
+            K_stack = range_knots_stack
+            build   = make_Z_field
+        else:
+            K_stack = ns_cov_batch(range_knots_stack @ gaussian_weight_matrix.T, sigsq_vec, sites_xy, kappa = nu, cov_model = "matern")
+            build   = lambda K: GaussianField(K, precision = True)
+        fields = []
+        for K in K_stack:
+            try:
+                fields.append(build(K))
+            except np.linalg.LinAlgError:
+                fields.append(None)
+        return fields
+
     # Scale Mixture R^phi
     gamma = 0.5 # this is the gamma that goes in rlevy, gamma_at_knots
     delta = 0.0 # this is the delta in levy, stays 0
@@ -218,11 +291,8 @@ if __name__ == "__main__":
 
         # rho - covariance K
         range_at_knots = np.array([])
-        distance_matrix = np.full(shape=(Ns, k), fill_value=np.nan)
         # distance from knots
-        for site_id in np.arange(Ns):
-            d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), XB = knots_xy)
-            distance_matrix[site_id,:] = d_from_knots
+        distance_matrix = scipy.spatial.distance.cdist(XA = sites_xy, XB = knots_xy)
         # each knot's "own" sites
         sites_within_knots = {}
         for knot_id in np.arange(k):
@@ -264,22 +334,19 @@ if __name__ == "__main__":
 
         # phi
         phi_at_knots = np.array([0.5] * k)
-        phi_vec = gaussian_weight_matrix @ phi_at_knots
+        phi_vec = phi_weight_matrix @ phi_at_knots
 
         # S ~ Stable
         if size == 1:
-            S_at_knots = np.full(shape = (k, Nt), fill_value = np.nan)
-            for t in np.arange(Nt):
-                obs_idx_1t  = np.where(miss_matrix[:,t] == False)[0]
-
-                pY_1t = pCGP(Y[obs_idx_1t, t], p,
-                             u_vec[obs_idx_1t], sigma_vec[obs_idx_1t], ksi_vec[obs_idx_1t])
-
-                # S_at_knots[:,t] = np.min(qRW(pY_1t[obs_idx_1t], phi_vec[obs_idx_1t], gamma_vec[obs_idx_1t], tau
-                #                                 ) / 2)**(1/phi_at_knots)
-
-                S_at_knots[:,t] = np.median(qRW(pY_1t[obs_idx_1t], phi_vec[obs_idx_1t], gamma_vec[obs_idx_1t], tau
-                                                ) / W[obs_idx_1t, t])**(1/phi_at_knots)
+            # all times in one pass: qRW on every observed (site, time), then a per-column median
+            obs_mask = ~miss_matrix
+            pY       = pCGP(Y[obs_mask], p, np.broadcast_to(u_vec[:,None], (Ns, Nt))[obs_mask],
+                            np.broadcast_to(sigma_vec[:,None], (Ns, Nt))[obs_mask],
+                            np.broadcast_to(ksi_vec[:,None],   (Ns, Nt))[obs_mask])
+            X_over_W           = np.full(shape = (Ns, Nt), fill_value = np.nan)
+            X_over_W[obs_mask] = qRW(pY, np.broadcast_to(phi_vec[:,None], (Ns, Nt))[obs_mask],
+                                     np.broadcast_to(gamma_vec[:,None], (Ns, Nt))[obs_mask], tau) / W[obs_mask]
+            S_at_knots = np.nanmedian(X_over_W, axis = 0)[None,:] ** (1/phi_at_knots)[:,None] # (k, Nt)
         if size > 1:
             comm.Barrier()
             obs_idx_1t  = np.where(miss_matrix[:,rank] == False)[0]
@@ -321,7 +388,7 @@ if __name__ == "__main__":
     Z         = scipy.stats.multivariate_normal.rvs(mean=np.zeros(shape=(Ns,)),cov=K,size=Nt).T
     W         = g(Z) 
 
-    phi_vec    = gaussian_weight_matrix @ phi_at_knots
+    phi_vec    = phi_weight_matrix @ phi_at_knots
     S_at_knots = np.full(shape = (k, Nt), fill_value = np.nan)
     for t in np.arange(Nt):
         S_at_knots[:,t] = rlevy(n = k, m = delta, s = gamma) # generate R at time t, spatially varying k knots
@@ -350,23 +417,13 @@ if __name__ == "__main__":
         plotgrid_X, plotgrid_Y = np.meshgrid(plotgrid_x, plotgrid_y)
         plotgrid_xy = np.vstack([plotgrid_X.ravel(), plotgrid_Y.ravel()]).T
 
-        gaussian_weight_matrix_for_plot = np.full(shape = (plotgrid_res_xy, k), fill_value = np.nan)
-        for site_id in np.arange(plotgrid_res_xy):
-            # Compute distance between each pair of the two collections of inputs
-            d_from_knots = scipy.spatial.distance.cdist(XA = plotgrid_xy[site_id,:].reshape((-1,2)), 
-                                            XB = knots_xy)
-            # influence coming from each of the knots
-            weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-            gaussian_weight_matrix_for_plot[site_id, :] = weight_from_knots
-
-        wendland_weight_matrix_for_plot = np.full(shape = (plotgrid_res_xy,k), fill_value = np.nan)
-        for site_id in np.arange(plotgrid_res_xy):
-            # Compute distance between each pair of the two collections of inputs
-            d_from_knots = scipy.spatial.distance.cdist(XA = plotgrid_xy[site_id,:].reshape((-1,2)), 
-                                            XB = knots_xy)
-            # influence coming from each of the knots
-            weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-            wendland_weight_matrix_for_plot[site_id, :] = weight_from_knots
+        gaussian_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'gaussian',
+                                                        radius = radius, bandwidth = bandwidth, cutoff = False)
+        phi_weight_matrix_for_plot      = weight_matrix(plotgrid_xy, knots_xy, basis = 'gaussian',
+                                                        radius = radius, bandwidth = bandwidth, cutoff = False, tol = phi_weight_tol)
+
+        wendland_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'wendland',
+                                                        radius = radius_from_knots)
         
         # weight from knot plots --------------------------------------------------------------------------------------
 
@@ -465,7 +522,7 @@ if __name__ == "__main__":
     
         # 3. phi surface
         # heatplot of phi surface
-        phi_vec_for_plot = (gaussian_weight_matrix_for_plot @ phi_at_knots).round(3)
+        phi_vec_for_plot = (phi_weight_matrix_for_plot @ phi_at_knots).round(3)
         graph, ax = plt.subplots()
         heatmap = ax.imshow(phi_vec_for_plot.reshape(plotgrid_res_y,plotgrid_res_x), 
                             cmap ='bwr', interpolation='nearest', extent = [minX, maxX, maxY, minY])
@@ -554,6 +611,12 @@ if __name__ == "__main__":
         phi_block_idx_size = 4
         range_block_idx_size = 4
 
+    # St: 'knotwise' --> one knot at a time, with the diagonal of S_log_cov; 'block' --> adaptive
+    # Metropolis (Haario et al. 2001) on blocks of S_block_idx_size knots, with this time's full
+    # S_log_cov, adapted online from the chain (S_block_idx_size = k: all of log St in one move)
+    S_update         = 'knotwise'
+    S_block_idx_size = k
+
     # Create Coefficient Index Blocks - each block size does not exceed size specified above
 
     ## phi
@@ -574,6 +637,49 @@ if __name__ == "__main__":
         key         = 'range_block_idx_'+str(i//range_block_idx_size+1)
         range_block_idx_dict[key] = lst[start_index:end_index]
 
+    ## sites reached by each phi block (knot --> sites index); None --> all sites
+    phi_block_sites_dict = {}
+    for key in phi_block_idx_dict.keys():
+        phi_block_sites_dict[key] = np.unique(np.concatenate([knot_support(phi_weight_csc, i)[0] for i in phi_block_idx_dict[key]])) \
+                                    if phi_weight_tol is not None else None
+
+    ## St (per time, on every rank)
+    S_block_idx_dict = {}
+    lst = list(range(k))
+    for i in range(0, k, S_block_idx_size):
+        start_index = i
+        end_index   = i + S_block_idx_size
+        key         = 'S_block_idx_'+str(i//S_block_idx_size+1)
+        S_block_idx_dict[key] = lst[start_index:end_index]
+
+    # Multiple proposals: n_proposals > 1 --> each phi/range block is updated by generalised
+    # Metropolis-Hastings with n_proposals proposals, evaluated together on every rank and
+    # selected from a single gather of the per-rank log-likelihood vectors
+    n_proposals = 1
+
+    # NN emulator of qRW (emulate_qRW.py), e.g. './data/qRW_LHS_5000000/', for the two options below
+    qRW_emulator_folder = None
+    qRW_emulator        = load_qRW_NN(qRW_emulator_folder) if qRW_emulator_folder is not None else None
+    # Delayed acceptance: each phi block and tau proposal is first screened with the emulated
+    # likelihood (Y_censored_ll_1t_NN); only the survivors get the exact qRW/dRW, and the second
+    # stage corrects for the screening, so the chain still targets the exact posterior (Christen & Fox 2005).
+    # The multi-proposal phi update (n_proposals > 1) is not screened: with both, only tau is
+    delayed_acceptance  = False
+    if rank == 0 and delayed_acceptance and n_proposals > 1:
+        print('delayed_acceptance with n_proposals > 1: the phi blocks are not screened, only tau')
+    # Emulator burn-in: iterations up to qRW_NN_burnin (burn-in and proposal adaptation) use the
+    # emulated qRW, as sampler_NNqRW.py does; from then on the same chain state and adapted
+    # proposals continue with the exact qRW. 0 --> exact throughout
+    qRW_NN_burnin       = 0
+    assert qRW_emulator is not None or (not delayed_acceptance and qRW_NN_burnin == 0), \
+        'delayed_acceptance and qRW_NN_burnin need the emulator: set qRW_emulator_folder'
+
+    # Marginal GPD: update Beta_logsigma and Beta_ksi (random walk, normal prior with sd sigma_Beta_*).
+    # A censored site's X is qRW(p) whatever its scale and shape, so each proposal recomputes
+    # qRW, dRW and the likelihood at the observed exceedance sites only (CopulaState1t.propose_GP);
+    # the missing sites keep the scale and shape their Y were imputed under
+    update_GPD          = False
+
     # Adaptive Update: tuning constants -------------------------------------------------------------------------------
 
     c_0 = 1
@@ -583,6 +689,7 @@ if __name__ == "__main__":
     # r_opt_2d = .35
     # r_opt = 0.234 # asymptotically
     r_opt = .35
+    r_opt_mala = .574 # MALA, asymptotically
     adapt_size = 10
 
     # Adaptive Update: Proposal Variance Scalar and Covariance Matrix -------------------------------------------------
@@ -601,10 +708,19 @@ if __name__ == "__main__":
         sigma_m_sq_St_list = [np.mean(np.diag(S_log_cov[:,:,t])) for t in range(Nt)] if rank == 0 and norm_pareto == 'shifted' else None
         sigma_m_sq_St_list = [(np.diag(S_log_cov[:,:,t])) for t in range(Nt)]        if rank == 0 and norm_pareto == 'standard' else None
         sigma_m_sq_St      = comm.scatter(sigma_m_sq_St_list, root = 0) if size>1 else sigma_m_sq_St_list[0]
+
+        # St blocks: scalar per block and this time's k x k covariance
+        Sigma_0_St_list = [({key: (2.4**2)/len(S_block_idx_dict[key]) for key in S_block_idx_dict.keys()}, S_log_cov[:,:,t].copy()) 
+                           for t in range(Nt)] if rank == 0 else None
+        sigma_m_sq_St_block, Sigma_0_St = comm.scatter(Sigma_0_St_list, root = 0) if size>1 else Sigma_0_St_list[0]
         
         # Zt
         sigma_m_sq_Zt_list = [(np.diag(Z_cov[:,:,t])) for t in range(Nt)] if rank == 0 else None
         sigma_m_sq_Zt      = comm.scatter(sigma_m_sq_Zt_list, root = 0) if size>1 else sigma_m_sq_Zt_list[0]
+
+        # (log St, Zt) MALA: squared step size and diagonal mass (preconditioner variances)
+        mala_list = [(1.65**2/(k + Ns)**(1/3), np.ones(k + Ns)) for t in range(Nt)] if rank == 0 else None
+        mala_eps_sq, mala_var = comm.scatter(mala_list, root = 0) if size>1 else mala_list[0]
         
         if rank == 0:
             sigma_m_sq = {}
@@ -680,6 +796,25 @@ if __name__ == "__main__":
             sigma_m_sq_Zt_list = None
         sigma_m_sq_Zt = comm.scatter(sigma_m_sq_Zt_list, root = 0) if size>1 else sigma_m_sq_Zt_list[0]
 
+        ## St blocks (checkpoints without them: start from the knotwise St variances)
+        if rank == 0 and os.path.exists('Sigma_0_St_list.pkl'):
+            with open('Sigma_0_St_list.pkl', 'rb') as file: Sigma_0_St_list = pickle.load(file)
+        elif rank == 0:
+            Sigma_0_St_list = [({key: (2.4**2)/len(S_block_idx_dict[key]) for key in S_block_idx_dict.keys()},
+                                np.diag(np.broadcast_to(sigma_m_sq_St_list[t], (k,)))) for t in range(Nt)]
+        else:
+            Sigma_0_St_list = None
+        sigma_m_sq_St_block, Sigma_0_St = comm.scatter(Sigma_0_St_list, root = 0) if size>1 else Sigma_0_St_list[0]
+
+        ## (log St, Zt) MALA (checkpoints without it: the fresh start values)
+        if rank == 0 and os.path.exists('mala_list.pkl'):
+            with open('mala_list.pkl', 'rb') as file: mala_list = pickle.load(file)
+        elif rank == 0:
+            mala_list = [(1.65**2/(k + Ns)**(1/3), np.ones(k + Ns)) for t in range(Nt)]
+        else:
+            mala_list = None
+        mala_eps_sq, mala_var = comm.scatter(mala_list, root = 0) if size>1 else mala_list[0]
+
         ## phi, range, tau, marginal Y, regularizations
         if rank == 0: 
             with open('sigma_m_sq.pkl','rb') as file: sigma_m_sq = pickle.load(file)
@@ -699,10 +834,16 @@ if __name__ == "__main__":
         num_accepted_St_list = [[0] * k] * size if rank == 0 else None
         num_accepted_St      = comm.scatter(num_accepted_St_list, root= 0) if size>1 else num_accepted_St_list[0]
     
+    ## St blocks
+    num_accepted_St_block = {key: 0 for key in S_block_idx_dict.keys()}
+
     ## Zt
     num_accepted_Zt_list = [[0] * Ns] * size if rank == 0 else None
     num_accepted_Zt      = comm.scatter(num_accepted_Zt_list, root = 0) if size>1 else num_accepted_Zt_list[0]
 
+    ## (log St, Zt) MALA
+    num_accepted_mala = 0
+
     ## Other variables: phi, range, tau, marginal Y, regularizaiton
     if rank == 0:
         num_accepted = {}
@@ -721,6 +862,17 @@ if __name__ == "__main__":
         num_accepted['sigma_Beta_logsigma'] = 0
         num_accepted['sigma_Beta_ksi']      = 0
         
+    # Adaptive Update: streaming moments ------------------------------------------------------------------------------
+    # mean and covariance of each adapted block since the last adaptation, accumulated as the
+    # chain runs (WelfordCovariance), so the adaptation never reads the traces back
+    if rank == 0:
+        phi_moments   = {key: WelfordCovariance(len(phi_block_idx_dict[key]))   for key in phi_block_idx_dict.keys()}
+        range_moments = {key: WelfordCovariance(len(range_block_idx_dict[key])) for key in range_block_idx_dict.keys()}
+        GPD_moments   = {'Beta_logsigma': WelfordCovariance(Beta_logsigma_m),
+                         'Beta_ksi'     : WelfordCovariance(Beta_ksi_m)}
+    S_log_moments = WelfordCovariance(k)                        # log St, per rank
+    mala_moments  = WelfordCovariance(k + Ns, diagonal = True) # (log St, Zt), per rank
+
     # %% Storage and Initialize ---------------------------------------------------------------------------------------
     # Storage and Initialize
             
@@ -738,6 +890,7 @@ if __name__ == "__main__":
         Y_trace                   = np.full(shape = (n_iters, Ns, Nt), fill_value = np.nan)          if rank == 0 else None
         tau_trace                 = np.full(shape = (n_iters, 1), fill_value = np.nan)               if rank == 0 else None
         Z_trace                   = np.full(shape = (n_iters, Ns, Nt), fill_value = np.nan)          if rank == 0 else None
+        Z_ess_trace               = np.full(shape = (n_iters, 2, Nt), fill_value = np.nan)           if rank == 0 else None # ESS likelihood evaluations, seconds
         # X_star_trace              = np.full(shape = (n_iters, Ns, Nt), fill_value = np.nan)          if rank == 0 else None
         # X_trace                   = np.full(shape = (n_iters, Ns, Nt), fill_value = np.nan)          if rank == 0 else None
     else:
@@ -753,8 +906,11 @@ if __name__ == "__main__":
         Y_trace                   = np.load('Y_trace.npy')                   if rank == 0 else None
         tau_trace                 = np.load('tau_trace.npy')                 if rank == 0 else None
         Z_trace                   = np.load('Z_trace.npy')                   if rank == 0 else None
+        Z_ess_trace               = np.load('Z_ess_trace.npy')               if rank == 0 and os.path.exists('Z_ess_trace.npy') else None
         # X_star_trace              = np.load('X_star_trace.npy')
         # X_trace                   = np.load('X_trace.npy')
+        if rank == 0 and Z_ess_trace is None: # checkpoints from before the ESS option
+            Z_ess_trace = np.full(shape = (n_iters, 2, Nt), fill_value = np.nan)
 
     # Initialize Parameters
     if start_iter == 1:
@@ -764,6 +920,8 @@ if __name__ == "__main__":
         range_knots_init         = range_at_knots      if rank == 0 else None
         Beta_logsigma_init       = Beta_logsigma       if rank == 0 else None
         Beta_ksi_init            = Beta_ksi            if rank == 0 else None
+        Beta_logsigma_imputed    = Beta_logsigma       if rank == 0 else None # the marginal the missing Y are imputed under
+        Beta_ksi_imputed         = Beta_ksi            if rank == 0 else None
         sigma_Beta_logsigma_init = sigma_Beta_logsigma if rank == 0 else None
         sigma_Beta_ksi_init      = sigma_Beta_ksi      if rank == 0 else None
         Y_matrix_init            = Y                   if rank == 0 else None
@@ -791,6 +949,8 @@ if __name__ == "__main__":
         range_knots_init         = range_knots_trace[last_iter,:]         if rank == 0 else None
         Beta_logsigma_init       = Beta_logsigma_trace[last_iter,:]       if rank == 0 else None
         Beta_ksi_init            = Beta_ksi_trace[last_iter,:]            if rank == 0 else None
+        Beta_logsigma_imputed    = Beta_logsigma_trace[0,:]               if rank == 0 else None # imputation is at the first iteration
+        Beta_ksi_imputed         = Beta_ksi_trace[0,:]                    if rank == 0 else None
         sigma_Beta_logsigma_init = sigma_Beta_logsigma_trace[last_iter,0] if rank == 0 else None # must be value, can't be array([value])
         sigma_Beta_ksi_init      = sigma_Beta_ksi_trace[last_iter,0]      if rank == 0 else None # must be value, can't be array([value])
         Y_matrix_init            = Y_trace[last_iter,:,:]                 if rank == 0 else None
@@ -806,6 +966,11 @@ if __name__ == "__main__":
     Beta_ksi_current      = comm.bcast(Beta_ksi_init, root = 0)
     Scale_vec_current     = np.exp((C_logsigma.T @ Beta_logsigma_current).T)[:,rank]
     Shape_vec_current     = ((C_ksi.T @ Beta_ksi_current).T)[:,rank]
+    ## ---- the missing sites keep the GPD surface their Y were imputed under (see update_GPD) ----
+    Beta_logsigma_imputed          = comm.bcast(Beta_logsigma_imputed, root = 0)
+    Beta_ksi_imputed               = comm.bcast(Beta_ksi_imputed, root = 0)
+    Scale_vec_current[miss_idx_1t] = np.exp((C_logsigma.T @ Beta_logsigma_imputed).T)[miss_idx_1t, rank]
+    Shape_vec_current[miss_idx_1t] = ((C_ksi.T @ Beta_ksi_imputed).T)[miss_idx_1t, rank]
 
     ## ---- GPD covariate coefficients prior variance ----
     sigma_Beta_logsigma_current = comm.bcast(sigma_Beta_logsigma_init, root = 0)
@@ -817,32 +982,34 @@ if __name__ == "__main__":
     #       hence we first "redundantly" broadcast an entire S_matrix then split
     S_matrix_init_log = comm.bcast(S_matrix_init_log, root = 0) # matrix (k, Nt)
     S_current_log     = np.array(S_matrix_init_log[:,rank]) # vector (k,)
-    R_vec_current     = wendland_weight_matrix @ np.exp(S_current_log)
+    R_vec_current     = wendland_weight_csc @ np.exp(S_current_log)
 
     ## ---- Z ----
-    Z_matrix_init = comm.bcast(Z_init, root = 0)    # matrix (Ns, Nt)
+    Z_matrix_init = node_shared.bcast(Z_init, root = 0) if node_shared is not None \
+                    else comm.bcast(Z_init, root = 0) # matrix (Ns, Nt)
     Z_1t_current = np.array(Z_matrix_init[:,rank]) # vector (Ns,)
 
     ## ---- phi ----
     phi_knots_current = comm.bcast(phi_knots_init, root = 0)
-    phi_vec_current   = gaussian_weight_matrix @ phi_knots_current
+    phi_vec_current   = phi_weight_matrix @ phi_knots_current
 
     ## ---- range_vec (length_scale) ----
     range_knots_current = comm.bcast(range_knots_init, root = 0)
     range_vec_current   = gaussian_weight_matrix @ range_knots_current
-    K_current           = ns_cov(range_vec = range_vec_current,
-                                 sigsq_vec = sigsq_vec, coords = sites_xy, kappa = nu, cov_model = "matern")
-    cholesky_matrix_current = scipy.linalg.cholesky(K_current, lower = False)
+    Z_field_current     = bcast_Z_field(comm, make_Z_field, range_knots_current, shared = node_shared) # cached factor of K, built on rank 0
+    Z_coloring          = precision_coloring(Z_field_current) if Z_update == 'coloured' else None
 
     ## ---- Nugget standard deviation: tau ----
     tau_current = comm.bcast(tau_init, root = 0)
 
     ## ---- X_star ----
-    X_star_1t_current = (R_vec_current ** phi_vec_current) * g(Z_1t_current)
+    gZ_1t_current     = g(Z_1t_current) # only changes with Z, one site at a time
+    X_star_1t_current = (R_vec_current ** phi_vec_current) * gZ_1t_current
 
     ## ---- Y (Ns, Nt) ----
-    Y_matrix_init = comm.bcast(Y_matrix_init, root = 0) # (Ns, Nt)
-    Y_1t_current  = Y_matrix_init[:,rank]               # (Ns,)
+    Y_matrix_init = node_shared.bcast(Y_matrix_init, root = 0) if node_shared is not None \
+                    else comm.bcast(Y_matrix_init, root = 0) # (Ns, Nt)
+    Y_1t_current  = np.array(Y_matrix_init[:,rank])          # (Ns,), imputed in place
     
     # initial imputation
     if start_iter == 1:
@@ -861,67 +1028,128 @@ if __name__ == "__main__":
     censored_idx_1t_current = np.where(Y_1t_current <= u_vec)[0]
     exceed_idx_1t_current   = np.where(Y_1t_current  > u_vec)[0]
 
-    ## ---- X_1t (Ns,) ----
-    X_1t_current  = qRW(pCGP(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current),
-                        phi_vec_current, gamma_vec, tau_current)
-    dX_1t_current = dRW(X_1t_current, phi_vec_current, gamma_vec, tau_current)
+    ## ---- State of this time replicate ----
+    # R_vec, X_star, X, dX, the per-site likelihood and the Gaussian term, recomputed only where
+    # a proposal makes them stale (see CopulaState1t). The arrays below are the state's own,
+    # updated in place by state_1t.commit(), so never assign to them.
+    state_1t = CopulaState1t(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current, gamma_vec,
+                             wendland_weight_csc, S_current_log, Z_1t_current, phi_vec_current, tau_current, Z_field_current,
+                             qRW_fun = make_qRW_NN(qRW_emulator) if start_iter <= qRW_NN_burnin else None)
+    S_current_log, R_vec_current, Z_1t_current, gZ_1t_current = state_1t.S_log, state_1t.R_vec, state_1t.Z, state_1t.gZ
+    phi_vec_current, X_star_1t_current                         = state_1t.phi_vec, state_1t.X_star
+    X_1t_current, dX_1t_current                                = state_1t.X, state_1t.dX
+    Scale_vec_current, Shape_vec_current                       = state_1t.scale_vec, state_1t.shape_vec
    
 
     # %% Metropolis-Hasting Updates -----------------------------------------------------------------------------------
     # Metropolis-Hasting Updates
+    # one time replicate per rank (size == Nt), also when size == 1; the (Ns, Nt) likelihood paths
+    # (Y_censored_ll_Nt, Z_field.logpdf of an Ns x Nt matrix) only serve the initial S estimate
+    # and the multi-proposal range scoring
     comm.Barrier() # Blocking before the update starts
 
     if rank == 0:
         start_time = time.time()
         print('started on:', strftime('%Y-%m-%d %H:%M:%S', localtime(time.time())))
 
-    llik_1t_current = Y_censored_ll_1t(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current,
-                                       R_vec_current, Z_1t_current, phi_vec_current, gamma_vec, tau_current,
-                                       X_1t_current, X_star_1t_current, dX_1t_current, censored_idx_1t_current, exceed_idx_1t_current) \
-                    + scipy.stats.multivariate_normal.logpdf(Z_1t_current, mean = None, cov = K_current)
-    
+    llik_1t_current = state_1t.llik
+
     if np.isfinite(llik_1t_current): 
         llik_1t_current_gathered = comm.gather(llik_1t_current, root = 0)
         if rank == 0: loglik_trace[0, 0] = np.sum(llik_1t_current_gathered)
     else: print('initial likelihood non finite', 'rank:', rank)
 
     for iter in range(start_iter, n_iters):
+        # Emulator burn-in over: same state and proposals, exact qRW from here on
+        if iter == qRW_NN_burnin + 1 and iter > start_iter:
+            state_1t.use_qRW(qRW)
+            llik_1t_current = state_1t.llik
+            if rank == 0: print('iter', iter, 'switched from the emulated to the exact qRW')
+        screen_with_NN = delayed_acceptance and iter > qRW_NN_burnin
+
         # %% Update St ------------------------------------------------------------------------------------------------
         ###########################################################
         #### ----- Update St ----- Parallelized Across Nt time ####
         ###########################################################
-        for i in range(k):
-            # propose new Stable St at knot i (No need truncation now?) -----------------------------------------------
-            change_idx = np.array([i])
-
-            S_proposal_log             = S_current_log.copy()
-            S_proposal_log[change_idx] = S_current_log[change_idx] + np.sqrt(sigma_m_sq_St[i]) * random_generator.normal(0.0, 1.0, size = 1)
-            
-            R_vec_proposal             = wendland_weight_matrix @ np.exp(S_proposal_log)
-            X_star_1t_proposal         = (R_vec_proposal ** phi_vec_current) * g(Z_1t_current)
+        if S_Z_update == 'mala':
+            # MALA (Roberts & Tweedie 1996) on x = (log St, Zt), preconditioned by the diagonal mass
+            # mala_var: x' ~ N(x + eps^2/2 mala_var grad(x), eps^2 mala_var), with the analytic gradients
+            # of the censored likelihood and the Gaussian term (CopulaState1t.grad_S_Z)
+            lprior_S      = lambda S_log: np.sum(kernels.levy_logpdf(np.exp(S_log), scale = gamma) + S_log)
+            lprior_S_grad = lambda S_log: -0.5 + 0.5 * gamma * np.exp(-S_log)
+            for step in range(mala_steps):
+                x_current    = np.concatenate([S_current_log, Z_1t_current])
+                grad_current = np.concatenate(state_1t.grad_S_Z())
+                grad_current[:k] += lprior_S_grad(S_current_log)
+                mean_current = x_current + 0.5 * mala_eps_sq * mala_var * grad_current
+                x_proposal   = mean_current + np.sqrt(mala_eps_sq * mala_var) * random_generator.normal(0.0, 1.0, size = k + Ns)
+
+                llik_1t_proposal  = state_1t.propose_S_Z(x_proposal[:k], x_proposal[k:])
+                grad_proposal     = np.concatenate(state_1t.grad_S_Z(proposal = True))
+                grad_proposal[:k] += lprior_S_grad(x_proposal[:k])
+                mean_proposal     = x_proposal + 0.5 * mala_eps_sq * mala_var * grad_proposal
+
+                # Update ------------------------------------------------------------------------------------------
+                log_q_ratio = (np.sum((x_proposal - mean_current)**2 / mala_var) - 
+                               np.sum((x_current - mean_proposal)**2 / mala_var)) / (2 * mala_eps_sq)
+                log_r       = llik_1t_proposal + lprior_S(x_proposal[:k]) - llik_1t_current - lprior_S(S_current_log) + log_q_ratio
+                if np.isfinite(log_r) and np.log(random_generator.uniform()) <= log_r:
+                    num_accepted_mala += 1
+                    state_1t.commit()
+                    llik_1t_current    = state_1t.llik
+                else:
+                    state_1t.rollback()
+                mala_moments.update(np.concatenate([S_current_log, Z_1t_current]))
+        elif S_update == 'block':
+            for key in S_block_idx_dict.keys():
+                # propose new log St at the block's knots -------------------------------------------------------------
+                idx = np.array(S_block_idx_dict[key])
+                S_proposal_log_block = S_current_log[idx] + np.sqrt(sigma_m_sq_St_block[key]) * \
+                                       random_generator.multivariate_normal(np.zeros(len(idx)), Sigma_0_St[np.ix_(idx, idx)])
+
+                # Data Likelihood -------------------------------------------------------------------------------------
+                # only the sites within the block's supports see the change
+                llik_1t_proposal = state_1t.propose_S_block(idx, S_proposal_log_block)
+
+                # Prior Density ---------------------------------------------------------------------------------------
+                # (the other knots' terms cancel)
+                lprior_1t_current  = np.sum(kernels.levy_logpdf(np.exp(S_current_log[idx]), scale = gamma) + S_current_log[idx])
+                lprior_1t_proposal = np.sum(kernels.levy_logpdf(np.exp(S_proposal_log_block), scale = gamma) + S_proposal_log_block)
+
+                # Update ----------------------------------------------------------------------------------------------
+                r = np.exp(llik_1t_proposal + lprior_1t_proposal - llik_1t_current - lprior_1t_current)
+                if np.isfinite(r) and r >= random_generator.uniform():
+                    num_accepted_St_block[key] += 1
+                    state_1t.commit()
+                    llik_1t_current = state_1t.llik
+                else:
+                    state_1t.rollback()
+        else:
+            for i in range(k):
+                # propose new Stable St at knot i (No need truncation now?) -------------------------------------------
+                S_proposal_log_i = S_current_log[i] + np.sqrt(sigma_m_sq_St[i]) * random_generator.normal(0.0, 1.0, size = 1)[0]
 
-            # Data Likelihood -----------------------------------------------------------------------------------------
+                # Data Likelihood -------------------------------------------------------------------------------------
+                # only the sites within knot i's radius see the change
+                llik_1t_proposal = state_1t.propose_S(i, S_proposal_log_i)
             
-            llik_1t_proposal = Y_censored_ll_1t(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current,
-                                                R_vec_proposal, Z_1t_current, phi_vec_current, gamma_vec, tau_current,
-                                                X_1t_current, X_star_1t_proposal, dX_1t_current, censored_idx_1t_current, exceed_idx_1t_current) \
-                             + scipy.stats.multivariate_normal.logpdf(Z_1t_current, mean = None, cov = K_current)
-            
-            # Prior Density -------------------------------------------------------------------------------------------
-            lprior_1t_current  = np.sum(scipy.stats.levy.logpdf(np.exp(S_current_log),  scale = gamma) + S_current_log)
-            lprior_1t_proposal = np.sum(scipy.stats.levy.logpdf(np.exp(S_proposal_log), scale = gamma) + S_proposal_log)
-
-            # Update --------------------------------------------------------------------------------------------------
-            r = np.exp(llik_1t_proposal + lprior_1t_proposal - llik_1t_current - lprior_1t_current)
-            u = random_generator.uniform()
-            if np.isfinite(r) and r >= u:
-                num_accepted_St[i] += 1
-                S_current_log       = S_proposal_log.copy()
-                R_vec_current       = wendland_weight_matrix @ np.exp(S_current_log)
-                X_star_1t_current   = (R_vec_current ** phi_vec_current) * g(Z_1t_current)
-                llik_1t_current     = llik_1t_proposal
+                # Prior Density ---------------------------------------------------------------------------------------
+                # (the other knots' terms cancel)
+                lprior_1t_current  = kernels.levy_logpdf(np.exp(S_current_log[i]), scale = gamma) + S_current_log[i]
+                lprior_1t_proposal = kernels.levy_logpdf(np.exp(S_proposal_log_i), scale = gamma) + S_proposal_log_i
+
+                # Update ----------------------------------------------------------------------------------------------
+                r = np.exp(llik_1t_proposal + lprior_1t_proposal - llik_1t_current - lprior_1t_current)
+                u = random_generator.uniform()
+                if np.isfinite(r) and r >= u:
+                    num_accepted_St[i] += 1
+                    state_1t.commit()
+                    llik_1t_current     = state_1t.llik
+                else:
+                    state_1t.rollback()
 
         # Save --------------------------------------------------------------------------------------------------------
+        S_log_moments.update(S_current_log)
         S_current_log_gathered = comm.gather(S_current_log, root = 0)
         if rank == 0: S_trace_log[iter,:,:]  = np.vstack(S_current_log_gathered).T
         
@@ -931,27 +1159,59 @@ if __name__ == "__main__":
         ###########################################################
         ####                 Update Zt                         ####
         ###########################################################
-        for i in range(Ns):
-            # propose new Zt at site i  -------------------------------------------------------------------------------
-            idx                = np.array([i])
-            Z_1t_proposal      = Z_1t_current.copy()
-            Z_1t_proposal[idx] = Z_1t_current[idx] + np.sqrt(sigma_m_sq_Zt[i]) * random_generator.normal(0.0, 1.0, size = 1)
-            X_star_1t_proposal = (R_vec_current ** phi_vec_current) * g(Z_1t_proposal)
+        if S_Z_update == 'mala':
+            pass # moved jointly with log St, above
+        elif Z_update == 'coloured':
+            # all sites of one colour at once: no edge between them in the precision graph, so
+            # each site is accepted or rejected on its own ratio, in one array pass per colour
+            for colour_idx in Z_coloring:
+                Z_1t_proposal_colour = Z_1t_current[colour_idx] + np.sqrt(np.asarray(sigma_m_sq_Zt)[colour_idx]) * \
+                                                                  random_generator.normal(0.0, 1.0, size = len(colour_idx))
+                log_r  = state_1t.propose_Z_sites(colour_idx, Z_1t_proposal_colour)
+                accept = np.log(random_generator.uniform(size = len(colour_idx))) <= np.nan_to_num(log_r, nan = np.NINF)
+                for i in colour_idx[accept]: num_accepted_Zt[i] += 1
+                state_1t.commit(accept)
+            llik_1t_current = state_1t.llik
+        elif Z_update == 'ess':
+            # elliptical slice sampling (Murray, Adams & MacKay 2010): Z_1t moves on the ellipse through
+            # Z_1t and a prior draw nu ~ N(0, K), shrinking the angle bracket until the data likelihood
+            # clears the slice; the prior draw uses the cached factor of K
+            ess_start   = time.time()
+            nu          = Z_field_current.rvs(random_generator)
+            Z_1t_ess    = Z_1t_current.copy()
+            log_slice   = state_1t.llik_sites.total + np.log(random_generator.uniform())
+            theta       = random_generator.uniform(0.0, 2*np.pi)
+            theta_range = [theta - 2*np.pi, theta]
+            n_ess_evals = 0
+            while True:
+                n_ess_evals += 1
+                if state_1t.propose_Z_vector(Z_1t_ess * np.cos(theta) + nu * np.sin(theta)) > log_slice:
+                    state_1t.commit()
+                    break
+                state_1t.rollback()
+                theta_range[0 if theta < 0 else 1] = theta
+                theta = random_generator.uniform(*theta_range)
+            llik_1t_current   = state_1t.llik
+            Z_ess_1t          = [n_ess_evals, time.time() - ess_start]
+            Z_ess_1t_gathered = comm.gather(Z_ess_1t, root = 0)
+            if rank == 0: Z_ess_trace[iter,:,:] = np.array(Z_ess_1t_gathered).T
+        else:
+            for i in range(Ns):
+                # propose new Zt at site i  ---------------------------------------------------------------------------
+                Z_1t_proposal_i = Z_1t_current[i] + np.sqrt(sigma_m_sq_Zt[i]) * random_generator.normal(0.0, 1.0, size = 1)[0]
 
-            # Data Likelihood -----------------------------------------------------------------------------------------
+                # Data Likelihood -------------------------------------------------------------------------------------
+                # one-site move: the Gaussian term goes through Qz = K^{-1} Z, O(Ns)
+                llik_1t_proposal = state_1t.propose_Z(i, Z_1t_proposal_i)
             
-            llik_1t_proposal = Y_censored_ll_1t(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current,
-                                                R_vec_current, Z_1t_proposal, phi_vec_current, gamma_vec, tau_current,
-                                                X_1t_current, X_star_1t_proposal, dX_1t_current, censored_idx_1t_current, exceed_idx_1t_current) \
-                             + scipy.stats.multivariate_normal.logpdf(Z_1t_proposal, mean = None, cov = K_current)
-            
-            # Update --------------------------------------------------------------------------------------------------
-            r = np.exp(llik_1t_proposal - llik_1t_current)
-            if np.isfinite(r) and r >= random_generator.uniform():
-                num_accepted_Zt[i] += 1
-                Z_1t_current      = Z_1t_proposal.copy()
-                X_star_1t_current = (R_vec_current ** phi_vec_current) * g(Z_1t_current)
-                llik_1t_current   = llik_1t_proposal
+                # Update ----------------------------------------------------------------------------------------------
+                r = np.exp(llik_1t_proposal - llik_1t_current)
+                if np.isfinite(r) and r >= random_generator.uniform():
+                    num_accepted_Zt[i] += 1
+                    state_1t.commit()
+                    llik_1t_current   = state_1t.llik
+                else:
+                    state_1t.rollback()
 
         # Save --------------------------------------------------------------------------------------------------------
         Z_1t_current_gathered = comm.gather(Z_1t_current, root = 0)
@@ -966,37 +1226,78 @@ if __name__ == "__main__":
         for key in phi_block_idx_dict.keys():
             # Propose new phi_block at the change_indices -------------------------------------------------------------
             idx = np.array(phi_block_idx_dict[key])
+            if n_proposals > 1:
+                # Generalised MH: n_proposals phi_knots, all evaluated in one batched pass per rank ------------------
+                if rank == 0:
+                    phi_knots_proposals = gmh_proposals(phi_knots_current, idx, sigma_m_sq[key] * Sigma_0[key], 
+                                                        n_proposals, random_generator)
+                else:
+                    phi_knots_proposals = None
+                phi_knots_proposals     = comm.bcast(phi_knots_proposals, root = 0)
+                valid_idx               = np.flatnonzero(np.all((0 < phi_knots_proposals) & (phi_knots_proposals < 1), axis = 1))
+
+                llik_1t_proposals = np.full(n_proposals, np.NINF)
+                if len(valid_idx) > 0:
+                    llik_1t_proposals[valid_idx] = state_1t.propose_phi_batch(phi_knots_proposals[valid_idx] @ phi_weight_matrix.T)
+
+                # Select --------------------------------------------------------------------------------------------
+                llik_1t_gathered = comm.gather(np.append(llik_1t_current, llik_1t_proposals), root = 0)
+                if rank == 0:
+                    log_post = np.sum(llik_1t_gathered, axis = 0) + \
+                               np.sum(kernels.beta_logpdf(np.vstack([phi_knots_current, phi_knots_proposals]), a = 5, b = 5), axis = 1)
+                    choice   = gmh_select(log_post, random_generator)
+                    if choice > 0: num_accepted[key] += 1
+                else:
+                    choice = None
+                choice = comm.bcast(choice, root = 0)
+
+                if choice > 0:
+                    phi_knots_current = phi_knots_proposals[choice - 1].copy()
+                    state_1t.select_phi(np.searchsorted(valid_idx, choice - 1))
+                    state_1t.commit()
+                    llik_1t_current   = state_1t.llik
+                continue
+
             if rank == 0:
                 phi_knots_proposal = phi_knots_current.copy()
                 phi_knots_proposal[idx] += np.sqrt(sigma_m_sq[key]) * random_generator.multivariate_normal(np.zeros(len(idx)), Sigma_0[key])
             else:
                 phi_knots_proposal = None
             phi_knots_proposal     = comm.bcast(phi_knots_proposal, root = 0)
+            phi_valid              = all(0 < phi < 1 for phi in phi_knots_proposal)
+
+            # Delayed Acceptance: screen with the emulated likelihood -------------------------------------------------
+            phi_screened = True
+            if screen_with_NN:
+                llik_NN_1t = [state_1t.llik_NN(qRW_emulator),
+                              state_1t.llik_NN(qRW_emulator, phi_vec = phi_weight_matrix @ phi_knots_proposal) if phi_valid else np.NINF]
+                llik_NN_1t_gathered = comm.gather(llik_NN_1t, root = 0)
+                if rank == 0:
+                    # emulated posterior, prior included, so that the prior cancels in the second stage
+                    llik_NN_current, llik_NN_proposal = np.sum(llik_NN_1t_gathered, axis = 0)
+                    llik_NN_current  += np.sum(kernels.beta_logpdf(phi_knots_current, a = 5, b = 5))
+                    llik_NN_proposal += np.sum(kernels.beta_logpdf(phi_knots_proposal, a = 5, b = 5))
+                    r = np.exp(llik_NN_proposal - llik_NN_current)
+                    phi_screened = bool(np.isfinite(r) and r >= random_generator.uniform())
+                phi_screened = comm.bcast(phi_screened, root = 0)
 
             # Data Likelihood -----------------------------------------------------------------------------------------
-            if not all(0 < phi < 1 for phi in phi_knots_proposal):
+            if not phi_valid or not phi_screened:
                 llik_1t_proposal = np.NINF
             else:
-                phi_vec_proposal       = gaussian_weight_matrix @ phi_knots_proposal
-                X_star_1t_proposal     = (R_vec_current ** phi_vec_proposal) * g(Z_1t_current)
-                X_1t_proposal = qRW(pCGP(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current),
-                                    phi_vec_proposal, gamma_vec, tau_current)
-                dX_1t_proposal = dRW(X_1t_proposal, phi_vec_proposal, gamma_vec, tau_current)
-
                 # Without Jacobian
-                llik_1t_proposal = Y_censored_ll_1t(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current,
-                                                    R_vec_current, Z_1t_current, phi_vec_proposal, gamma_vec, tau_current,
-                                                    X_1t_proposal, X_star_1t_proposal, dX_1t_proposal, censored_idx_1t_current, exceed_idx_1t_current) \
-                                 + scipy.stats.multivariate_normal.logpdf(Z_1t_current, mean = None, cov = K_current)
+                llik_1t_proposal = state_1t.propose_phi(phi_weight_matrix @ phi_knots_proposal, sites = phi_block_sites_dict[key])
 
             # Update --------------------------------------------------------------------------------------------------
             phi_accepted = False
             llik_1t_current_gathered  = comm.gather(llik_1t_current, root = 0)
             llik_1t_proposal_gathered = comm.gather(llik_1t_proposal, root = 0)
             if rank == 0:
-                llik_current  = np.sum(llik_1t_current_gathered)  + np.sum(scipy.stats.beta.logpdf(phi_knots_current, a = 5, b = 5))
-                llik_proposal = np.sum(llik_1t_proposal_gathered) + np.sum(scipy.stats.beta.logpdf(phi_knots_proposal, a = 5, b = 5))
+                llik_current  = np.sum(llik_1t_current_gathered)  + np.sum(kernels.beta_logpdf(phi_knots_current, a = 5, b = 5))
+                llik_proposal = np.sum(llik_1t_proposal_gathered) + np.sum(kernels.beta_logpdf(phi_knots_proposal, a = 5, b = 5))
                 r = np.exp(llik_proposal - llik_current)
+                if screen_with_NN and phi_screened: # second stage: exact over emulated posterior ratio
+                    r *= np.exp(llik_NN_current - llik_NN_proposal)
                 if np.isfinite(r) and r >= random_generator.uniform():
                     num_accepted[key] += 1
                     phi_accepted       = True
@@ -1004,14 +1305,15 @@ if __name__ == "__main__":
             
             if phi_accepted:
                 phi_knots_current = phi_knots_proposal.copy()
-                phi_vec_current   = phi_vec_proposal.copy()
-                X_star_1t_current = X_star_1t_proposal.copy()
-                X_1t_current      = X_1t_proposal.copy()
-                dX_1t_current     = dX_1t_proposal.copy()
+                state_1t.commit()
                 llik_1t_current   = llik_1t_proposal
+            else:
+                state_1t.rollback()
         
         # Save --------------------------------------------------------------------------------------------------------
-        if rank == 0: phi_knots_trace[iter,:] = phi_knots_current.copy()
+        if rank == 0: 
+            phi_knots_trace[iter,:] = phi_knots_current.copy()
+            for key in phi_block_idx_dict.keys(): phi_moments[key].update(phi_knots_current[phi_block_idx_dict[key]])
         comm.Barrier()
 
         # %% Update rho ------------------------------------------------------------------------------------------------
@@ -1021,6 +1323,38 @@ if __name__ == "__main__":
         for key in range_block_idx_dict.keys():
             # Propose new range_block at the change_indices -----------------------------------------------------------
             idx = np.array(range_block_idx_dict[key])
+            if n_proposals > 1:
+                # Generalised MH: range only enters through the Gaussian density of Z, so rank 0 scores all
+                # n_proposals fields against the gathered Z matrix (from the Z update) and only the selected
+                # field is broadcast ---------------------------------------------------------------------------
+                if rank == 0:
+                    range_knots_proposals = gmh_proposals(range_knots_current, idx, sigma_m_sq[key] * Sigma_0[key], 
+                                                          n_proposals, random_generator)
+                    valid_idx             = np.flatnonzero(np.all(range_knots_proposals > 0, axis = 1))
+                    Z_fields_proposal     = [None] * n_proposals
+                    for j, field in zip(valid_idx, make_Z_fields(range_knots_proposals[valid_idx])):
+                        Z_fields_proposal[j] = field
+                    Z_matrix = Z_trace[iter,:,:]
+                    log_post = np.array([np.sum(field.logpdf(Z_matrix)) if field is not None else np.NINF
+                                         for field in [Z_field_current] + Z_fields_proposal]) + \
+                               np.sum(kernels.halfnorm_logpdf(np.vstack([range_knots_current, range_knots_proposals]), loc = 0, scale = 2), axis = 1)
+                    choice   = gmh_select(log_post, random_generator)
+                    if choice > 0: 
+                        num_accepted[key]   += 1
+                        range_knots_current  = range_knots_proposals[choice - 1].copy()
+                else:
+                    choice = None
+                choice = comm.bcast(choice, root = 0)
+
+                if choice > 0:
+                    range_knots_current = comm.bcast(range_knots_current, root = 0)
+                    Z_field_current     = bcast_Z_field(comm, lambda field: field, Z_fields_proposal[choice - 1] if rank == 0 else None,
+                                                        shared = node_shared, current = Z_field_current)
+                    state_1t.propose_range(Z_field_current)
+                    state_1t.commit()
+                    llik_1t_current     = state_1t.llik
+                continue
+
             if rank == 0:
                 range_knots_proposal = range_knots_current.copy()
                 range_knots_proposal[idx] += np.sqrt(sigma_m_sq[key]) * random_generator.multivariate_normal(np.zeros(len(idx)), Sigma_0[key])
@@ -1032,22 +1366,22 @@ if __name__ == "__main__":
             if not all(rho > 0 for rho in range_knots_proposal):
                 llik_1t_proposal = np.NINF
             else:
-                range_vec_proposal = gaussian_weight_matrix @ range_knots_proposal
-                K_proposal = ns_cov(range_vec = range_vec_proposal,
-                                    sigsq_vec = sigsq_vec, coords = sites_xy, kappa = nu, cov_model = "matern")
-                # Without Jacobian
-                llik_1t_proposal = Y_censored_ll_1t(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current,
-                                                    R_vec_current, Z_1t_current, phi_vec_current, gamma_vec, tau_current,
-                                                    X_1t_current, X_star_1t_current, dX_1t_current, censored_idx_1t_current, exceed_idx_1t_current) \
-                                 + scipy.stats.multivariate_normal.logpdf(Z_1t_current, mean = None, cov = K_proposal)
+                # K_proposal is constructed and factorised once, on rank 0, then broadcast
+                Z_field_proposal = bcast_Z_field(comm, make_Z_field, range_knots_proposal,
+                                                 shared = node_shared, current = Z_field_current)
+                if Z_field_proposal is None: # K_proposal not positive definite
+                    llik_1t_proposal = np.NINF
+                else:
+                    # Without Jacobian
+                    llik_1t_proposal = state_1t.propose_range(Z_field_proposal)
             
             # Update --------------------------------------------------------------------------------------------------
             range_accepted = False
             llik_1t_current_gathered  = comm.gather(llik_1t_current, root = 0)
             llik_1t_proposal_gathered = comm.gather(llik_1t_proposal, root = 0)
             if rank == 0:
-                llik_current  = np.sum(llik_1t_current_gathered)  + np.sum(scipy.stats.halfnorm.logpdf(range_knots_current, loc = 0, scale = 2))
-                llik_proposal = np.sum(llik_1t_proposal_gathered) + np.sum(scipy.stats.halfnorm.logpdf(range_knots_proposal, loc = 0, scale = 2))
+                llik_current  = np.sum(llik_1t_current_gathered)  + np.sum(kernels.halfnorm_logpdf(range_knots_current, loc = 0, scale = 2))
+                llik_proposal = np.sum(llik_1t_proposal_gathered) + np.sum(kernels.halfnorm_logpdf(range_knots_proposal, loc = 0, scale = 2))
                 r = np.exp(llik_proposal - llik_current)
                 if np.isfinite(r) and r >= random_generator.uniform():
                     num_accepted[key] += 1
@@ -1056,11 +1390,16 @@ if __name__ == "__main__":
             
             if range_accepted:
                 range_knots_current = range_knots_proposal.copy()
-                K_current           = K_proposal.copy()
+                Z_field_current     = Z_field_proposal
+                state_1t.commit()
                 llik_1t_current     = llik_1t_proposal
+            else:
+                state_1t.rollback()
 
         # Save --------------------------------------------------------------------------------------------------------
-        if rank == 0: range_knots_trace[iter,:] = range_knots_current.copy()
+        if rank == 0: 
+            range_knots_trace[iter,:] = range_knots_current.copy()
+            for key in range_block_idx_dict.keys(): range_moments[key].update(range_knots_current[range_block_idx_dict[key]])
         comm.Barrier()
 
         # %% Update tau ------------------------------------------------------------------------------------------------
@@ -1074,19 +1413,27 @@ if __name__ == "__main__":
             tau_proposal = None
         tau_proposal = comm.bcast(tau_proposal, root = 0)
 
+        # Delayed Acceptance: screen with the emulated likelihood -----------------------------------------------------
+        tau_screened = True
+        if screen_with_NN:
+            llik_NN_1t = [state_1t.llik_NN(qRW_emulator),
+                          state_1t.llik_NN(qRW_emulator, tau = tau_proposal) if tau_proposal > 0 else np.NINF]
+            llik_NN_1t_gathered = comm.gather(llik_NN_1t, root = 0)
+            if rank == 0:
+                # emulated posterior, prior included, so that the prior cancels in the second stage
+                llik_NN_current, llik_NN_proposal = np.sum(llik_NN_1t_gathered, axis = 0)
+                llik_NN_current  += kernels.halft_logpdf(tau_current, nu = 1, mu = 0, sigma = 5)
+                llik_NN_proposal += kernels.halft_logpdf(tau_proposal, nu = 1, mu = 0, sigma = 5) if tau_proposal > 0 else np.NINF
+                r = np.exp(llik_NN_proposal - llik_NN_current)
+                tau_screened = bool(np.isfinite(r) and r >= random_generator.uniform())
+            tau_screened = comm.bcast(tau_screened, root = 0)
+
         # Data Likelihood ---------------------------------------------------------------------------------------------
-        if not tau_proposal > 0:
+        if not tau_proposal > 0 or not tau_screened:
             llik_1t_proposal = np.NINF
         else:
-            X_1t_proposal = qRW(pCGP(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current),
-                                phi_vec_current, gamma_vec, tau_proposal)
-            dX_1t_proposal = dRW(X_1t_proposal, phi_vec_current, gamma_vec, tau_proposal)
-
             # Without Jacobian
-            llik_1t_proposal = Y_censored_ll_1t(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current,
-                                                R_vec_current, Z_1t_current, phi_vec_current, gamma_vec, tau_proposal,
-                                                X_1t_proposal, X_star_1t_current, dX_1t_proposal, censored_idx_1t_current, exceed_idx_1t_current) \
-                                + scipy.stats.multivariate_normal.logpdf(Z_1t_current, mean = None, cov = K_current)
+            llik_1t_proposal = state_1t.propose_tau(tau_proposal)
 
         # Update ------------------------------------------------------------------------------------------------------
         tau_accepted = False
@@ -1095,9 +1442,11 @@ if __name__ == "__main__":
         if rank == 0:
             llik_current  = np.sum(llik_1t_current_gathered)
             llik_proposal = np.sum(llik_1t_proposal_gathered)
-            lprior_tau_current  = np.log(dhalft(tau_current, nu = 1, mu = 0, sigma = 5))
-            lprior_tau_proposal = np.log(dhalft(tau_proposal, nu = 1, mu = 0, sigma = 5)) if tau_proposal > 0 else np.NINF
+            lprior_tau_current  = kernels.halft_logpdf(tau_current, nu = 1, mu = 0, sigma = 5)
+            lprior_tau_proposal = kernels.halft_logpdf(tau_proposal, nu = 1, mu = 0, sigma = 5) if tau_proposal > 0 else np.NINF
             r = np.exp(llik_proposal + lprior_tau_proposal - llik_current - lprior_tau_current)
+            if screen_with_NN and tau_screened: # second stage: exact over emulated posterior ratio
+                r *= np.exp(llik_NN_current - llik_NN_proposal)
             if np.isfinite(r) and r >= random_generator.uniform():
                 num_accepted['tau'] += 1
                 tau_accepted         = True
@@ -1105,9 +1454,10 @@ if __name__ == "__main__":
         
         if tau_accepted:
             tau_current     = tau_proposal
-            X_1t_current    = X_1t_proposal.copy()
-            dX_1t_current   = dX_1t_proposal.copy()
+            state_1t.commit()
             llik_1t_current = llik_1t_proposal
+        else:
+            state_1t.rollback()
         
         # Save --------------------------------------------------------------------------------------------------------
         if rank == 0: tau_trace[iter,:] = tau_current
@@ -1117,6 +1467,63 @@ if __name__ == "__main__":
         ############################################################
         ####                 Update GPD                         ####
         ############################################################
+        # Beta_logsigma and Beta_ksi, one block each; only the exceedance sites are recomputed
+        if update_GPD:
+            for key in ['Beta_logsigma', 'Beta_ksi']:
+                Beta_current       = Beta_logsigma_current       if key == 'Beta_logsigma' else Beta_ksi_current
+                sigma_Beta_current = sigma_Beta_logsigma_current if key == 'Beta_logsigma' else sigma_Beta_ksi_current
+
+                # Propose new Beta ------------------------------------------------------------------------------------
+                if rank == 0:
+                    Beta_proposal = Beta_current + np.sqrt(sigma_m_sq[key]) * \
+                                    random_generator.multivariate_normal(np.zeros(len(Beta_current)), Sigma_0[key])
+                else:
+                    Beta_proposal = None
+                Beta_proposal = comm.bcast(Beta_proposal, root = 0)
+
+                # Data Likelihood -------------------------------------------------------------------------------------
+                if key == 'Beta_logsigma':
+                    Scale_vec_proposal = np.exp((C_logsigma.T @ Beta_proposal).T)[:,rank]
+                    Shape_vec_proposal = Shape_vec_current
+                else:
+                    Scale_vec_proposal = Scale_vec_current
+                    Shape_vec_proposal = ((C_ksi.T @ Beta_proposal).T)[:,rank]
+                # Without Jacobian
+                llik_1t_proposal = state_1t.propose_GP(Scale_vec_proposal, Shape_vec_proposal, sites = obs_idx_1t)
+
+                # Update ----------------------------------------------------------------------------------------------
+                Beta_accepted = False
+                llik_1t_current_gathered  = comm.gather(llik_1t_current, root = 0)
+                llik_1t_proposal_gathered = comm.gather(llik_1t_proposal, root = 0)
+                if rank == 0:
+                    llik_current  = np.sum(llik_1t_current_gathered)
+                    llik_proposal = np.sum(llik_1t_proposal_gathered)
+                    lprior_Beta_current  = np.sum(kernels.norm_logpdf(Beta_current, 0, sigma_Beta_current))
+                    lprior_Beta_proposal = np.sum(kernels.norm_logpdf(Beta_proposal, 0, sigma_Beta_current))
+                    r = np.exp(llik_proposal + lprior_Beta_proposal - llik_current - lprior_Beta_current)
+                    if np.isfinite(r) and r >= random_generator.uniform():
+                        num_accepted[key] += 1
+                        Beta_accepted      = True
+                Beta_accepted = comm.bcast(Beta_accepted, root = 0)
+
+                if Beta_accepted:
+                    if key == 'Beta_logsigma': Beta_logsigma_current = Beta_proposal
+                    else:                      Beta_ksi_current      = Beta_proposal
+                    state_1t.commit()
+                    llik_1t_current = llik_1t_proposal
+                else:
+                    state_1t.rollback()
+
+        # Save --------------------------------------------------------------------------------------------------------
+        if rank == 0:
+            Beta_logsigma_trace[iter,:]       = Beta_logsigma_current
+            Beta_ksi_trace[iter,:]            = Beta_ksi_current
+            sigma_Beta_logsigma_trace[iter,:] = sigma_Beta_logsigma_current
+            sigma_Beta_ksi_trace[iter,:]      = sigma_Beta_ksi_current
+            if update_GPD:
+                GPD_moments['Beta_logsigma'].update(Beta_logsigma_current)
+                GPD_moments['Beta_ksi'].update(Beta_ksi_current)
+        comm.Barrier()
 
 
         # %% After iteration likelihood
@@ -1131,6 +1538,8 @@ if __name__ == "__main__":
         # censored_ll_1t, exceed_ll_1t = Y_censored_ll_1t_detail(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current,
         #                                                        R_vec_current, Z_1t_current, phi_vec_current, gamma_vec, tau_current,
         #                                                        X_1t_current, X_star_1t_current, dX_1t_current, censored_idx_1t_current, exceed_idx_1t_current)
+        # K_current = ns_cov(range_vec = gaussian_weight_matrix @ range_knots_current,
+        #                    sigsq_vec = sigsq_vec, coords = sites_xy, kappa = nu, cov_model = "matern") # the fields keep no K
         # D_gauss_ll_1t, log_J_1_1t, log_J_2_1t = X_star_conditional_ll_1t_detail(X_star_1t_current, R_vec_current, phi_vec_current, K_current, Z_1t_current)
         # censored_ll_gathered = comm.gather(censored_ll_1t, root = 0)
         # exceed_ll_gathered   = comm.gather(exceed_ll_1t,   root = 0)
@@ -1145,7 +1554,7 @@ if __name__ == "__main__":
         censored_ll_1t, exceed_ll_1t = Y_censored_ll_1t_detail(Y_1t_current, p, u_vec, Scale_vec_current, Shape_vec_current,
                                                                R_vec_current, Z_1t_current, phi_vec_current, gamma_vec, tau_current,
                                                                X_1t_current, X_star_1t_current, dX_1t_current, censored_idx_1t_current, exceed_idx_1t_current)
-        D_gauss_ll_1t = scipy.stats.multivariate_normal.logpdf(Z_1t_current, mean = None, cov=K_current)
+        D_gauss_ll_1t = state_1t.Z_ll
         censored_ll_gathered = comm.gather(censored_ll_1t, root = 0)
         exceed_ll_gathered   = comm.gather(exceed_ll_1t,   root = 0)        
         D_gauss_ll_gathered  = comm.gather(D_gauss_ll_1t,  root = 0)
@@ -1164,48 +1573,81 @@ if __name__ == "__main__":
             gamma1 = 1 / ((iter/adapt_size + offset) ** c_1)
             gamma2 = c_0 * gamma1
 
-            # St
+            # St (only while the knotwise moves run: otherwise nothing is accepted and the scales would decay)
             if norm_pareto == 'standard':
-                for i in range(k):
-                    r_hat              = num_accepted_St[i]/adapt_size
-                    num_accepted_St[i] = 0
-                    log_sigma_m_sq_hat = np.log(sigma_m_sq_St[i]) + gamma2 * (r_hat - r_opt)
-                    sigma_m_sq_St[i]   = np.exp(log_sigma_m_sq_hat)
+                if S_update == 'knotwise' and S_Z_update != 'mala':
+                    for i in range(k):
+                        r_hat              = num_accepted_St[i]/adapt_size
+                        num_accepted_St[i] = 0
+                        log_sigma_m_sq_hat = np.log(sigma_m_sq_St[i]) + gamma2 * (r_hat - r_opt)
+                        sigma_m_sq_St[i]   = np.exp(log_sigma_m_sq_hat)
                 comm.Barrier()
                 sigma_m_sq_St_list     = comm.gather(sigma_m_sq_St, root = 0)
+
+            # St blocks: adaptive Metropolis, covariance from this rank's window of log St
+            if S_update == 'block' and S_Z_update != 'mala':
+                Sigma_0_St_hat = S_log_moments.cov
+                for key in S_block_idx_dict.keys():
+                    idx                        = np.ix_(S_block_idx_dict[key], S_block_idx_dict[key])
+                    r_hat                      = num_accepted_St_block[key]/adapt_size
+                    num_accepted_St_block[key] = 0
+                    log_sigma_m_sq_hat         = np.log(sigma_m_sq_St_block[key]) + gamma2 * (r_hat - r_opt)
+                    sigma_m_sq_St_block[key]   = np.exp(log_sigma_m_sq_hat)
+                    Sigma_0_St[idx]            = Sigma_0_St[idx] + gamma1 * (Sigma_0_St_hat[idx] - Sigma_0_St[idx])
+            S_log_moments.reset()
+            Sigma_0_St_list = comm.gather((sigma_m_sq_St_block, Sigma_0_St), root = 0)
             
-            # Zt
-            for i in range(Ns):
-                r_hat              = num_accepted_Zt[i]/adapt_size
-                num_accepted_Zt[i] = 0
-                log_sigma_m_sq_hat = np.log(sigma_m_sq_Zt[i]) + gamma2 * (r_hat - r_opt)
-                sigma_m_sq_Zt[i]   = np.exp(log_sigma_m_sq_hat)
+            # Zt (elliptical slice sampling has nothing to tune, and MALA does every Z move)
+            if Z_update in ('sitewise', 'coloured') and S_Z_update != 'mala':
+                for i in range(Ns):
+                    r_hat              = num_accepted_Zt[i]/adapt_size
+                    num_accepted_Zt[i] = 0
+                    log_sigma_m_sq_hat = np.log(sigma_m_sq_Zt[i]) + gamma2 * (r_hat - r_opt)
+                    sigma_m_sq_Zt[i]   = np.exp(log_sigma_m_sq_hat)
             comm.Barrier()
             sigma_m_sq_Zt_list = comm.gather(sigma_m_sq_Zt, root = 0)
 
+            # (log St, Zt) MALA: step size towards r_opt_mala, mass from the window's variances
+            if S_Z_update == 'mala':
+                r_hat             = num_accepted_mala/(adapt_size * mala_steps)
+                num_accepted_mala = 0
+                mala_eps_sq       = np.exp(np.log(mala_eps_sq) + gamma2 * (r_hat - r_opt_mala))
+                mala_var          = mala_var + gamma1 * (np.maximum(mala_moments.cov, 1e-8) - mala_var)
+                mala_moments.reset()
+            mala_list = comm.gather((mala_eps_sq, mala_var), root = 0)
+
             # phi
             if rank == 0:
                 for key in phi_block_idx_dict.keys():
-                    start_idx          = phi_block_idx_dict[key][0]
-                    end_idx            = phi_block_idx_dict[key][-1]+1
                     r_hat              = num_accepted[key]/adapt_size
                     num_accepted[key]  = 0
                     log_sigma_m_sq_hat = np.log(sigma_m_sq[key]) + gamma2 * (r_hat - r_opt)
                     sigma_m_sq[key]    = np.exp(log_sigma_m_sq_hat)
-                    Sigma_0_hat        = np.array(np.cov(phi_knots_trace[iter-adapt_size:iter, start_idx:end_idx].T))
+                    Sigma_0_hat        = phi_moments[key].cov
                     Sigma_0[key]       = Sigma_0[key] + gamma1 * (Sigma_0_hat - Sigma_0[key])
+                    phi_moments[key].reset()
 
             # range
             if rank == 0:
                 for key in range_block_idx_dict.keys():
-                    start_idx          = range_block_idx_dict[key][0]
-                    end_idx            = range_block_idx_dict[key][-1]+1
                     r_hat              = num_accepted[key]/adapt_size
                     num_accepted[key]  = 0
                     log_sigma_m_sq_hat = np.log(sigma_m_sq[key]) + gamma2 * (r_hat - r_opt)
                     sigma_m_sq[key]    = np.exp(log_sigma_m_sq_hat)
-                    Sigma_0_hat        = np.array(np.cov(range_knots_trace[iter-adapt_size:iter, start_idx:end_idx].T))
+                    Sigma_0_hat        = range_moments[key].cov
+                    Sigma_0[key]       = Sigma_0[key] + gamma1 * (Sigma_0_hat - Sigma_0[key])
+                    range_moments[key].reset()
+
+            # GPD
+            if rank == 0 and update_GPD:
+                for key in ['Beta_logsigma', 'Beta_ksi']:
+                    r_hat              = num_accepted[key]/adapt_size
+                    num_accepted[key]  = 0
+                    log_sigma_m_sq_hat = np.log(sigma_m_sq[key]) + gamma2 * (r_hat - r_opt)
+                    sigma_m_sq[key]    = np.exp(log_sigma_m_sq_hat)
+                    Sigma_0_hat        = GPD_moments[key].cov
                     Sigma_0[key]       = Sigma_0[key] + gamma1 * (Sigma_0_hat - Sigma_0[key])
+                    GPD_moments[key].reset()
 
             # tau
             if rank == 0:
@@ -1231,15 +1673,23 @@ if __name__ == "__main__":
                 np.save('loglik_trace',      loglik_trace)
                 np.save('S_trace_log',       S_trace_log)
                 np.save('Z_trace',           Z_trace)
+                np.save('Z_ess_trace',       Z_ess_trace)
                 np.save('phi_knots_trace',   phi_knots_trace)
                 np.save('range_knots_trace', range_knots_trace)
                 np.save('tau_trace',         tau_trace)
+                np.save('Beta_logsigma_trace',       Beta_logsigma_trace)
+                np.save('Beta_ksi_trace',            Beta_ksi_trace)
+                np.save('sigma_Beta_logsigma_trace', sigma_Beta_logsigma_trace)
+                np.save('sigma_Beta_ksi_trace',      sigma_Beta_ksi_trace)
 
                 with open('iter.pkl', 'wb')               as file: pickle.dump(iter, file)
                 with open('sigma_m_sq.pkl', 'wb')         as file: pickle.dump(sigma_m_sq, file)
                 with open('Sigma_0.pkl', 'wb')            as file: pickle.dump(Sigma_0, file)
                 with open('sigma_m_sq_St_list.pkl', 'wb') as file: pickle.dump(sigma_m_sq_St_list, file)
                 with open('sigma_m_sq_Zt_list.pkl', 'wb') as file: pickle.dump(sigma_m_sq_Zt_list, file)
+                with open('mala_list.pkl', 'wb')          as file: pickle.dump(mala_list, file)
+                with open('Sigma_0_St_list.pkl', 'wb')    as file: pickle.dump(Sigma_0_St_list, file)
+                with open('phi_weight_tol.pkl', 'wb')     as file: pickle.dump(phi_weight_tol, file)
 
                 # Drawing ---------------------------------------------------------------------------------------------
                 
@@ -76,34 +76,7 @@ if __name__ == "__main__":
     if norm_pareto == 'standard': n_iters = 400000
     
     # helper functions ------
-    def relu_np(x): # changes x IN PLACE! faster than return x * (x > 0)
-        np.maximum(x, 0, x)
-
-    def identity(x):
-        pass
-
-    # the output is 1D if X is 1D
-    #               2D if X is 2D
-    def NNqRW_predict(Ws, bs, activations, X):
-        Z = X
-        for W, b, activation in zip(Ws, bs, activations):
-            Z = Z @ W + b
-            activation(Z)
-        return np.exp(Z)
-    
-    def qRW_NN(Ws, bs, acts,
-               p, phi, gamma, tau):
-        Ns     = len(p)
-        inputs = np.column_stack((p, 
-                                  phi,
-                                  gamma, 
-                                  np.full((Ns,),tau)))
-        emul_idx = np.where(inputs[:,0]  < 0.995)[0]
-        ni_idx   = np.where(inputs[:,0] >= 0.995)[0]
-        outputs  = np.full((Ns,), fill_value = np.nan)
-        outputs[emul_idx] = NNqRW_predict(Ws, bs, acts, inputs[emul_idx]).ravel()
-        outputs[ni_idx]   = qRW(inputs[ni_idx,0], inputs[ni_idx,1], inputs[ni_idx,2], tau)
-        return outputs
+    # relu_np, identity, NNqRW_predict, qRW_NN and load_qRW_NN live in utilities
 
     # %% Load Dataset and Emulator ------------------------------------------------------------------------------------
 
@@ -118,13 +91,7 @@ if __name__ == "__main__":
     elevations         = np.load('./data/'+datafolder+'elevations.npy')
 
     # load emulator
-    with open('./data/'+modelfolder+'qRW_NN_Ws.pkl',   'rb') as f:
-        Ws = pickle.load(f)
-    with open('./data/'+modelfolder+'qRW_NN_bs.pkl',   'rb') as f:
-        bs = pickle.load(f)
-    with open('./data/'+modelfolder+'qRW_NN_acts.pkl', 'rb') as f:
-        acts_str = pickle.load(f)
-        acts     = [relu_np if act_str == 'relu' else identity for act_str in acts_str]
+    Ws, bs, acts = load_qRW_NN('./data/'+modelfolder)
 
     # %% Load Real Dataset --------------------------------------------------------------------------------------------
 
@@ -195,24 +162,12 @@ if __name__ == "__main__":
 
     # Generate the weight matrices
     # Weight matrix generated using Gaussian Smoothing Kernel
-    gaussian_weight_matrix = np.full(shape = (Ns, k), fill_value = np.nan)
-    for site_id in np.arange(Ns):
-        # Compute distance between each pair of the two collections of inputs
-        d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                        XB = knots_xy)
-        # influence coming from each of the knots
-        weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-        gaussian_weight_matrix[site_id, :] = weight_from_knots
+    gaussian_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'gaussian',
+                                           radius = radius, bandwidth = bandwidth, cutoff = False)
 
     # Weight matrix generated using wendland basis
-    wendland_weight_matrix = np.full(shape = (Ns,k), fill_value = np.nan)
-    for site_id in np.arange(Ns):
-        # Compute distance between each pair of the two collections of inputs
-        d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                        XB = knots_xy)
-        # influence coming from each of the knots
-        weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-        wendland_weight_matrix[site_id, :] = weight_from_knots
+    wendland_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'wendland',
+                                           radius = radius_from_knots)
     
     # Marginal Model - GP(sigma, ksi) threshold u ---------------------------------------------------------------------
     
@@ -270,11 +225,8 @@ if __name__ == "__main__":
 
         # rho - covariance K
         range_at_knots = np.array([])
-        distance_matrix = np.full(shape=(Ns, k), fill_value=np.nan)
         # distance from knots
-        for site_id in np.arange(Ns):
-            d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), XB = knots_xy)
-            distance_matrix[site_id,:] = d_from_knots
+        distance_matrix = scipy.spatial.distance.cdist(XA = sites_xy, XB = knots_xy)
         # each knot's "own" sites
         sites_within_knots = {}
         for knot_id in np.arange(k):
@@ -409,23 +361,11 @@ if __name__ == "__main__":
         plotgrid_X, plotgrid_Y = np.meshgrid(plotgrid_x, plotgrid_y)
         plotgrid_xy = np.vstack([plotgrid_X.ravel(), plotgrid_Y.ravel()]).T
 
-        gaussian_weight_matrix_for_plot = np.full(shape = (plotgrid_res_xy, k), fill_value = np.nan)
-        for site_id in np.arange(plotgrid_res_xy):
-            # Compute distance between each pair of the two collections of inputs
-            d_from_knots = scipy.spatial.distance.cdist(XA = plotgrid_xy[site_id,:].reshape((-1,2)), 
-                                            XB = knots_xy)
-            # influence coming from each of the knots
-            weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-            gaussian_weight_matrix_for_plot[site_id, :] = weight_from_knots
-
-        wendland_weight_matrix_for_plot = np.full(shape = (plotgrid_res_xy,k), fill_value = np.nan)
-        for site_id in np.arange(plotgrid_res_xy):
-            # Compute distance between each pair of the two collections of inputs
-            d_from_knots = scipy.spatial.distance.cdist(XA = plotgrid_xy[site_id,:].reshape((-1,2)), 
-                                            XB = knots_xy)
-            # influence coming from each of the knots
-            weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-            wendland_weight_matrix_for_plot[site_id, :] = weight_from_knots
+        gaussian_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'gaussian',
+                                                        radius = radius, bandwidth = bandwidth, cutoff = False)
+
+        wendland_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'wendland',
+                                                        radius = radius_from_knots)
         
         # weight from knot plots --------------------------------------------------------------------------------------
 
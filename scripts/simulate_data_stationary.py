@@ -106,24 +106,12 @@ if __name__ == "__main__":
     assert k == len(knots_xy)
     
     # Weight matrix generated using Gaussian Smoothing Kernel
-    gaussian_weight_matrix = np.full(shape = (Ns, k), fill_value = np.nan)
-    for site_id in np.arange(Ns):
-        # Compute distance between each pair of the two collections of inputs
-        d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                        XB = knots_xy)
-        # influence coming from each of the knots
-        weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-        gaussian_weight_matrix[site_id, :] = weight_from_knots
+    gaussian_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'gaussian',
+                                           radius = radius, bandwidth = bandwidth, cutoff = False)
 
     # Weight matrix generated using wendland basis
-    wendland_weight_matrix = np.full(shape = (Ns,k), fill_value = np.nan)
-    for site_id in np.arange(Ns):
-        # Compute distance between each pair of the two collections of inputs
-        d_from_knots = scipy.spatial.distance.cdist(XA = sites_xy[site_id,:].reshape((-1,2)), 
-                                        XB = knots_xy)
-        # influence coming from each of the knots
-        weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-        wendland_weight_matrix[site_id, :] = weight_from_knots
+    wendland_weight_matrix = weight_matrix(sites_xy, knots_xy, basis = 'wendland',
+                                           radius = radius_from_knots)
     
     # -----------------------------------------------------------------------------------------------------------------
     # Setup For the Model 
@@ -367,23 +355,11 @@ if __name__ == "__main__":
     plotgrid_X, plotgrid_Y = np.meshgrid(plotgrid_x, plotgrid_y)
     plotgrid_xy = np.vstack([plotgrid_X.ravel(), plotgrid_Y.ravel()]).T
 
-    gaussian_weight_matrix_for_plot = np.full(shape = (plotgrid_res_xy, k), fill_value = np.nan)
-    for site_id in np.arange(plotgrid_res_xy):
-        # Compute distance between each pair of the two collections of inputs
-        d_from_knots = scipy.spatial.distance.cdist(XA = plotgrid_xy[site_id,:].reshape((-1,2)), 
-                                        XB = knots_xy)
-        # influence coming from each of the knots
-        weight_from_knots = weights_fun(d_from_knots, radius, bandwidth, cutoff = False)
-        gaussian_weight_matrix_for_plot[site_id, :] = weight_from_knots
-
-    wendland_weight_matrix_for_plot = np.full(shape = (plotgrid_res_xy,k), fill_value = np.nan)
-    for site_id in np.arange(plotgrid_res_xy):
-        # Compute distance between each pair of the two collections of inputs
-        d_from_knots = scipy.spatial.distance.cdist(XA = plotgrid_xy[site_id,:].reshape((-1,2)), 
-                                        XB = knots_xy)
-        # influence coming from each of the knots
-        weight_from_knots = wendland_weights_fun(d_from_knots, radius_from_knots)
-        wendland_weight_matrix_for_plot[site_id, :] = weight_from_knots
+    gaussian_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'gaussian',
+                                                    radius = radius, bandwidth = bandwidth, cutoff = False)
+
+    wendland_weight_matrix_for_plot = weight_matrix(plotgrid_xy, knots_xy, basis = 'wendland',
+                                                    radius = radius_from_knots)
 
 
     # 1. Station, Knots 
@@ -0,0 +1,53 @@
+# check the log-density kernels (kernels.py) against the scipy.stats calls they replace
+# on the support: |kernel - scipy| <= TOL * max(1, |scipy|); off the support both are -inf
+#   python test_kernels.py
+# %%
+# general imports
+import numpy as np
+import scipy.stats
+import kernels
+
+TOL = 1e-12
+rng = np.random.default_rng(2024)
+
+def check(name, ll, ll_scipy):
+    ll, ll_scipy = np.broadcast_arrays(np.asarray(ll, dtype = 'float64'), np.asarray(ll_scipy, dtype = 'float64'))
+    finite = np.isfinite(ll_scipy)
+    assert np.array_equal(np.isfinite(ll), finite), name + ': support differs'
+    assert np.all(ll[~finite] == ll_scipy[~finite]), name + ': off-support values differ'
+    err = np.max(np.abs(ll[finite] - ll_scipy[finite]) / np.maximum(1, np.abs(ll_scipy[finite])), initial = 0.0)
+    assert err <= TOL, name + ': relative error ' + str(err)
+    print(f'{name:<28} ok, max relative error {err:.1e} ({np.sum(~finite)} off-support points)')
+
+# %% Normal
+x     = rng.normal(0, 5, 1000)
+loc   = rng.normal(0, 2, 1000)
+scale = rng.uniform(0.1, 10, 1000)
+check('norm_logpdf',  kernels.norm_logpdf(x, loc, scale), scipy.stats.norm.logpdf(x, loc, scale))
+check('norm_logcdf',  kernels.norm_logcdf(x, loc, scale), scipy.stats.norm.logcdf(x, loc, scale))
+
+# %% Generalized Pareto, shape < 0, = 0, > 0, with points below the threshold and (shape < 0)
+# beyond the upper end point loc - scale/shape
+loc   = rng.uniform(0, 2, 1000)
+scale = rng.uniform(0.5, 3, 1000)
+y     = loc + rng.uniform(-1, 15, 1000)
+for shape in [-0.4, -0.1, 0.0, 0.1, 0.4]:
+    check(f'genpareto_logpdf ({shape:+.1f})', kernels.genpareto_logpdf(y, loc, scale, shape),
+          scipy.stats.genpareto.logpdf(y, c = shape, loc = loc, scale = scale))
+    check(f'cgp_logpdf ({shape:+.1f})',       kernels.cgp_logpdf(y, 0.9, loc, scale, shape),
+          np.where(y <= loc, -np.inf, np.log(1-0.9) + scipy.stats.genpareto.logpdf(y, c = shape, loc = loc, scale = scale)))
+shape = rng.uniform(-0.4, 0.4, 1000) # per site
+shape[::10] = 0
+check('genpareto_logpdf (mixed)', kernels.genpareto_logpdf(y, loc, scale, shape),
+      scipy.stats.genpareto.logpdf(y, c = shape, loc = loc, scale = scale))
+
+# %% Priors
+x = rng.uniform(-1, 20, 1000)
+check('levy_logpdf',     kernels.levy_logpdf(x, 0, 0.5),          scipy.stats.levy.logpdf(x, 0, 0.5))
+x = np.concatenate([rng.uniform(-0.5, 1.5, 1000), [0.0, 1.0]])
+check('beta_logpdf',     kernels.beta_logpdf(x, a = 5, b = 5),    scipy.stats.beta.logpdf(x, a = 5, b = 5))
+x = rng.uniform(-2, 10, 1000)
+check('halfnorm_logpdf', kernels.halfnorm_logpdf(x, 0, 2),        scipy.stats.halfnorm.logpdf(x, 0, 2))
+for nu in [1, 3]:
+    check(f'halft_logpdf (nu = {nu})', kernels.halft_logpdf(x, nu, 0, 5),
+          np.where(x >= 0, np.log(2) + scipy.stats.t.logpdf(x, nu, loc = 0, scale = 5), -np.inf))
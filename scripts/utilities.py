@@ -5,11 +5,16 @@
 # %%
 # general imports and ubiquitous utilities
 import sys
+import copy
+import pickle
 import numpy as np
 import scipy
 import scipy.special as sc
+import scipy.sparse
+import scipy.sparse.linalg
 from scipy.spatial import distance
 import RW_inte
+import kernels
 norm_pareto = 'standard'
 
 # %% spatial covariance functions copied from ns_cov
@@ -55,9 +60,12 @@ def ns_cov(range_vec, sigsq_vec, coords, kappa = 0.5, cov_model = "matern"):
     ##    coords = N x 2 matrix of coordinates
     ##    cov.model = "matern" --> underlying covariance model: "gaussian", "exponential", or "matern"
     ##    kappa = 0.5 --> Matern smoothness, scalar
+    ##    range_vec can also be an M x N matrix of M stacked range vectors, see ns_cov_batch
     if type(range_vec).__module__!='numpy' or isinstance(range_vec, np.float64):
         range_vec = np.array(range_vec)
         sigsq_vec = np.array(sigsq_vec)
+    if range_vec.ndim == 2:
+        return ns_cov_batch(range_vec, sigsq_vec, coords, kappa = kappa, cov_model = cov_model)
     
     N = range_vec.shape[0] # Number of spatial locations
     if coords.shape[0]!=N: 
@@ -123,6 +131,81 @@ def ns_cov(range_vec, sigsq_vec, coords, kappa = 0.5, cov_model = "matern"):
   
     Spatial_cov = np.diag(sigsq_vec).dot(NS_corr).dot(np.diag(sigsq_vec)) 
     return(Spatial_cov)
+
+def ns_cov_batch(range_mat, sigsq_vec, coords, kappa = 0.5, cov_model = "matern", return_chol = False):
+    ## Arguments:
+    ##    range_mat = M x N matrix, M stacked range vectors (e.g. M proposals of a range block)
+    ##    sigsq_vec = N-vector of marginal variance parameters, shared by all M
+    ##    coords = N x 2 matrix of coordinates
+    ##    return_chol = False --> also return the M x N x N stack of lower Cholesky factors
+    ## Same as np.array([ns_cov(range_vec, ...) for range_vec in range_mat]), but the
+    ## pairwise geometry is computed once and the M covariances are built together
+    range_mat = np.atleast_2d(range_mat)
+    M, N = range_mat.shape
+    if coords.shape[0]!=N:
+        sys.exit('Number of spatial locations should be equal to the number of range parameters.')
+
+    # Geometry, shared by all M (coordinate differences; sgn * |d1| * sgn * |d2| = d1 * d2)
+    diff1 = np.reshape(coords[:,0], (N, 1)) - coords[:,0]
+    diff2 = np.reshape(coords[:,1], (N, 1)) - coords[:,1]
+    dists1_sq = diff1**2
+    dists2_sq = diff2**2
+    dists12   = diff1*diff2
+
+    # Scale matrix (arg11 = arg22 = range, arg12 = 0)
+    mat11 = 0.5*(range_mat[:,:,None] + range_mat[:,None,:]) # M x N x N
+    mat22 = mat11
+    mat12 = np.zeros(mat11.shape)
+    det12 = mat11*mat22 - mat12**2
+    det1_quarter = np.sqrt(range_mat)                         # (arg11*arg22 - arg12**2)**(1/4)
+    Scale_mat = det1_quarter[:,:,None] * np.sqrt(1/det12) * det1_quarter[:,None,:]
+
+    # Distance matrix
+    inv11 = mat22/det12
+    inv22 = mat11/det12
+    inv12 = -mat12/det12
+    Dist_mat_sqd = inv11*dists1_sq + 2*inv12*dists12 + inv22*dists2_sq
+    Dist_mat = np.zeros(Dist_mat_sqd.shape)
+    Dist_mat[Dist_mat_sqd>0] = np.sqrt(Dist_mat_sqd[Dist_mat_sqd>0])
+
+    # Combine
+    Unscl_corr = cov_spatial(Dist_mat, cov_model = cov_model, cov_pars = np.array([1,1]), kappa = kappa)
+    NS_corr = Scale_mat*Unscl_corr
+
+    Spatial_cov = sigsq_vec[:,None] * NS_corr * sigsq_vec[None,:]
+    if return_chol:
+        return Spatial_cov, np.linalg.cholesky(Spatial_cov)
+    return Spatial_cov
+
+def ns_cov_cross(range_vec1, sigsq_vec1, coords1, range_vec2, sigsq_vec2, coords2, kappa = 0.5, cov_model = "matern"):
+    ## Arguments:
+    ##    range_vec1, sigsq_vec1, coords1 = N1 locations and their parameters (as in ns_cov)
+    ##    range_vec2, sigsq_vec2, coords2 = N2 locations and their parameters
+    ## N1 x N2 cross-covariance of the same nonstationary model as ns_cov, i.e. the
+    ## off-diagonal block of ns_cov on the N1 + N2 locations stacked together
+    N1, N2 = range_vec1.shape[0], range_vec2.shape[0]
+    if coords1.shape[0]!=N1 or coords2.shape[0]!=N2:
+        sys.exit('Number of spatial locations should be equal to the number of range parameters.')
+
+    # Scale matrix (arg11 = arg22 = range, arg12 = 0)
+    mat11 = 0.5*(np.reshape(range_vec1, (N1, 1)) + range_vec2)
+    Scale_mat = np.reshape(np.sqrt(range_vec1), (N1, 1)) * (1/mat11) * np.sqrt(range_vec2)
+
+    # Distance matrix
+    Dist_mat = np.sqrt(distance.cdist(coords1, coords2, 'sqeuclidean') / mat11)
+
+    # Combine
+    Unscl_corr = cov_spatial(Dist_mat, cov_model = cov_model, cov_pars = np.array([1,1]), kappa = kappa)
+    NS_corr = Scale_mat*Unscl_corr
+
+    Spatial_cov = np.reshape(sigsq_vec1, (N1, 1)) * NS_corr * sigsq_vec2
+    return Spatial_cov
+
+def ns_cov_blocks(range_vec, sigsq_vec, coords, kappa = 0.5, cov_model = "matern"):
+    # idx -> ns_cov(...)[np.ix_(idx, idx)], built from the len(idx) sites alone (ns_cov_cross),
+    # for the neighbour blocks of vecchia_factor without the N x N matrix
+    return lambda idx: ns_cov_cross(range_vec[idx], sigsq_vec[idx], coords[idx],
+                                    range_vec[idx], sigsq_vec[idx], coords[idx], kappa = kappa, cov_model = cov_model)
     
 
 def ns_cov_interp(range_vec, sigsq_vec, coords, tck):
@@ -200,6 +283,415 @@ def ns_cov_interp(range_vec, sigsq_vec, coords, tck):
     return(Spatial_cov)
 ## -------------------------------------------------------------------------- ##
 
+## -------------------------------------------------------------------------- ##
+##        Vecchia (nearest-neighbour conditioning) Gaussian log-density
+## -------------------------------------------------------------------------- ##
+# Approximate the joint density of Z ~ N(mean, K) by
+#   p(z) = prod_j p(z_{o_j} | z_{N(o_j)}),
+# where o is an ordering of the sites and N(o_j) holds the (at most) m nearest
+# sites among o_1, ..., o_{j-1}. Each conditional only needs an m x m block of K,
+# so one evaluation costs O(N m^3) instead of the O(N^3) of the dense density.
+
+def maxmin_ordering(coords):
+    # Greedy max-min distance ordering (Guinness 2018):
+    #   start at the site closest to the centroid, then repeatedly pick the site
+    #   that is farthest away from all the sites already ordered
+    N      = coords.shape[0]
+    order  = np.empty(N, dtype = int)
+    first  = np.argmin(np.sum((coords - np.mean(coords, axis = 0))**2, axis = 1))
+    min_d  = np.sqrt(np.sum((coords - coords[first])**2, axis = 1))
+    order[0]     = first
+    min_d[first] = -np.inf
+    for j in range(1, N):
+        nxt        = np.argmax(min_d)
+        order[j]   = nxt
+        min_d      = np.minimum(min_d, np.sqrt(np.sum((coords - coords[nxt])**2, axis = 1)))
+        min_d[nxt] = -np.inf
+    return order
+
+def vecchia_neighbors(coords, m = 30, ordering = 'maxmin'):
+    ## Arguments:
+    ##    coords = N x 2 matrix of coordinates
+    ##    m = 30 --> maximum number of conditioning neighbours
+    ##    ordering = 'maxmin' --> 'maxmin', 'coord' (sort by x then y), or 'none' (as given)
+    ## Returns:
+    ##    order = N-vector, sites in the order they are conditioned on
+    ##    nn    = N x m matrix, nn[j] holds the indices of the nearest neighbours of
+    ##            site order[j] among order[:j], padded with -1
+    N = coords.shape[0]
+    if ordering == 'maxmin':
+        order = maxmin_ordering(coords)
+    elif ordering == 'coord':
+        order = np.lexsort((coords[:,1], coords[:,0]))
+    elif ordering == 'none':
+        order = np.arange(N)
+    else:
+        sys.exit("Please specify a valid ordering (maxmin, coord, or none).")
+
+    nn = np.full(shape = (N, m), fill_value = -1, dtype = int)
+    ordered_coords = coords[order]
+    for j in range(1, N):
+        d_prev = np.sum((ordered_coords[:j] - ordered_coords[j])**2, axis = 1)
+        n_nb   = min(m, j)
+        nb     = np.argpartition(d_prev, n_nb - 1)[:n_nb] if n_nb < j else np.arange(j)
+        nn[j, :n_nb] = order[nb]
+    return order, nn
+
+# per-site vector v (or N x m matrix) shaped to broadcast against an (N,) or (N, T) array x
+def site_col(v, x):
+    v = np.asarray(v)
+    return np.reshape(v, v.shape + (1,) * (np.ndim(x) - v.ndim)) if np.ndim(x) > v.ndim else v
+
+def vecchia_factor(K, order, nn):
+    # Conditional regression coefficients and variances of the Vecchia approximation:
+    #   z_{o_j} | z_{N(o_j)} ~ N(B[j] @ z_{N(o_j)}, d[j])
+    # K = N x N covariance matrix, or a function idx -> K[np.ix_(idx, idx)] (e.g. ns_cov_blocks),
+    # so that only the (m+1) x (m+1) blocks of the sites and their neighbours are ever built
+    cov_block = K if callable(K) else (lambda idx: K[np.ix_(idx, idx)])
+    N, m = nn.shape
+    B = np.zeros(shape = (N, m))
+    d = np.empty(N)
+    for j in range(N):
+        i   = order[j]
+        nb  = nn[j][nn[j] >= 0]
+        K_j = cov_block(np.append(nb, i)) # site i last
+        if len(nb) == 0:
+            d[j] = K_j[0,0]
+            continue
+        k_nb = K_j[:-1, -1]
+        b    = scipy.linalg.cho_solve(scipy.linalg.cho_factor(K_j[:-1, :-1], lower = True), k_nb)
+        B[j, :len(nb)] = b
+        d[j] = K_j[-1,-1] - k_nb @ b
+    return B, d
+
+def vecchia_logpdf(x, order, nn, B, d, mean = None):
+    # Vecchia approximation of the N(mean, K) log-density, from the factor (B, d) of K
+    # x can also be N x T, T fields at once (one log-density per column)
+    z = np.asarray(x, dtype = 'float64') if mean is None else np.asarray(x, dtype = 'float64') - site_col(mean, x)
+    # padded neighbours (-1) have zero coefficients, so whatever they pick up is discarded
+    cond_mean = np.sum(site_col(B, z[nn]) * z[nn], axis = 1)
+    e         = z[order] - cond_mean
+    return -0.5 * (len(z) * np.log(2*np.pi) + np.sum(np.log(d)) + np.sum(e**2 / site_col(d, e), axis = 0))
+
+def make_vecchia_logpdf(coords, m = 30, ordering = 'maxmin'):
+    # Drop-in replacement for scipy.stats.multivariate_normal.logpdf(x, mean, cov)
+    # on a fixed set of sites; the neighbour sets are computed once, here
+    order, nn = vecchia_neighbors(coords, m = m, ordering = ordering)
+    def logpdf(x, mean = None, cov = None):
+        B, d = vecchia_factor(cov, order, nn)
+        return vecchia_logpdf(x, order, nn, B, d, mean = mean)
+    return logpdf
+## -------------------------------------------------------------------------- ##
+
+## -------------------------------------------------------------------------- ##
+##               Cached factorisation of the Gaussian field N(0, K)
+## -------------------------------------------------------------------------- ##
+# K only changes when a range proposal is accepted, so factorise it once and
+# reuse the factor for every S, Z, phi and tau proposal in between.
+#   Z_field          = GaussianField(K_current)
+#   Z_field_proposal = GaussianField(K_proposal)  # range proposal
+#   Z_field          = Z_field_proposal           # only if accepted
+# For one-site moves of z, track Qz = K^{-1} z: the change in log-density is
+#   -(dz (Qz)_i + dz^2 Q_ii / 2),   and on acceptance Qz += dz Q[:,i],
+# both O(N) given the column Q[:,i] (precision_column, provided by every field).
+#   Qz   = Z_field.precision_dot(z)
+#   q_i  = Z_field.precision_column(i)
+#   dlog = Z_field.delta_logpdf(Qz, i, dz, q_i)
+# Sites with no edge between them in the graph of Q (Q[i,j] = 0) are conditionally
+# independent given the others, so they can be moved together and the change splits
+# by site (precision_coloring groups the sites into such sets).
+
+class _SingleSiteDelta:
+    def precision_graph(self):
+        # sparse Q whose zero pattern is the conditional-independence graph; None --> dense
+        return None
+
+    def delta_logpdf(self, Qz, i, dz, q_i = None):
+        # log N(z + dz e_i) - log N(z), from Qz = K^{-1} z
+        q_ii = self.precision_column(i)[i] if q_i is None else q_i[i]
+        return -(dz * Qz[i] + 0.5 * dz**2 * q_ii)
+
+    def update_Qz(self, Qz, i, dz, q_i = None):
+        # in place, after z[i] += dz is accepted
+        Qz += dz * (self.precision_column(i) if q_i is None else q_i)
+        return Qz
+
+class GaussianField(_SingleSiteDelta):
+    def __init__(self, K, precision = False, chol = None):
+        ## Arguments:
+        ##    K = N x N covariance matrix
+        ##    precision = False --> also keep Q = K^{-1}
+        ##    chol = None --> lower Cholesky factor of K, if already computed (e.g. by ns_cov_batch)
+        ## K itself is not kept: everything goes through its factor (and Q), which is all
+        ## bcast_Z_field has to ship
+        self.N      = K.shape[0]
+        self.chol   = scipy.linalg.cholesky(K, lower = True) if chol is None else chol # K = L L^T
+        self.logdet = 2*np.sum(np.log(np.diag(self.chol)))
+        self.Q      = scipy.linalg.cho_solve((self.chol, True), np.eye(self.N)) if precision else None
+
+    def logpdf(self, z):
+        # log N(z; 0, K), O(N^2) from the cached factor
+        # z can be N x T: one multi-right-hand-side solve, one log-density per column
+        e = scipy.linalg.solve_triangular(self.chol, z, lower = True)
+        return -0.5 * (self.N * np.log(2*np.pi) + self.logdet + np.sum(e**2, axis = 0))
+
+    def precision_dot(self, z):
+        return scipy.linalg.cho_solve((self.chol, True), z)
+
+    def precision_column(self, i):
+        # needs Q: build the field with precision = True (done once, on root, by bcast_Z_field)
+        if self.Q is None:
+            self.Q = scipy.linalg.cho_solve((self.chol, True), np.eye(self.N))
+        return self.Q[:,i]
+
+    def precision_diagonal(self):
+        if self.Q is None:
+            self.Q = scipy.linalg.cho_solve((self.chol, True), np.eye(self.N))
+        return np.diag(self.Q).copy()
+
+    def rvs(self, random_state = None):
+        # z = L e ~ N(0, K), from the cached factor
+        random_state = np.random.mtrand._rand if random_state is None else random_state
+        return self.chol @ random_state.standard_normal(self.N)
+
+class VecchiaGaussianField(_SingleSiteDelta):
+    def __init__(self, K, order, nn):
+        ## Arguments:
+        ##    K = N x N covariance matrix, or the blocks of it, ns_cov_blocks(...) (not kept)
+        ##    order, nn = output of vecchia_neighbors()
+        self.N     = len(order)
+        self.order = order
+        self.nn    = nn
+        self.B, self.d = vecchia_factor(K, order, nn)
+        # sparse precision Q = L^T diag(1/d) L, with (L z)_j = z[order[j]] - B[j] @ z[nn[j]]
+        rows = np.repeat(np.arange(self.N), nn.shape[1])
+        keep = nn.ravel() >= 0 # drop the -1 padding
+        L    = scipy.sparse.csr_matrix((np.concatenate([np.ones(self.N), -self.B.ravel()[keep]]),
+                                        (np.concatenate([np.arange(self.N), rows[keep]]),
+                                         np.concatenate([order, nn.ravel()[keep]]))),
+                                       shape = (self.N, self.N))
+        self.Q = (L.T @ scipy.sparse.diags(1/self.d) @ L).tocsc()
+        self.L_ordered = L[:, order].tocsr() # lower triangular: neighbours come earlier in the ordering
+
+    def logpdf(self, z):
+        # Vecchia approximation of log N(z; 0, K), O(N m)
+        return vecchia_logpdf(z, self.order, self.nn, self.B, self.d)
+
+    def precision_dot(self, z):
+        return self.Q @ z
+
+    def precision_column(self, i):
+        return self.Q[:,i].toarray().ravel()
+
+    def precision_diagonal(self):
+        return self.Q.diagonal()
+
+    def precision_graph(self):
+        return self.Q
+
+    def rvs(self, random_state = None):
+        # draw from the Vecchia approximation: L z = sqrt(d) e, one sparse triangular solve
+        random_state = np.random.mtrand._rand if random_state is None else random_state
+        z = np.empty(self.N)
+        z[self.order] = scipy.sparse.linalg.spsolve_triangular(self.L_ordered, np.sqrt(self.d) * random_state.standard_normal(self.N),
+                                                              lower = True)
+        return z
+
+## -------------------------------------------------------------------------- ##
+##               Predictive-process (low-rank) Gaussian field
+## -------------------------------------------------------------------------- ##
+# Modified predictive process through m knots (Banerjee et al. 2008, Finley et al. 2009):
+#   K ~= C_sk C_kk^{-1} C_ks + D,  D = diag(K - C_sk C_kk^{-1} C_ks)
+# so K ~= A^T A + D with A = L_kk^{-1} C_ks (m x N), and everything goes through
+# the m x m matrix M = I + A D^{-1} A^T:
+#   K^{-1}   = D^{-1} - D^{-1} A^T M^{-1} A D^{-1}   (Woodbury)
+#   log|K|   = log|D| + log|M|                       (determinant lemma)
+# O(N m^2) to build, O(N m) per logpdf, and no N x N matrix anywhere.
+
+class PredictiveProcessField(_SingleSiteDelta):
+    def __init__(self, C_kk, C_ks, diag_K):
+        ## Arguments:
+        ##    C_kk = m x m covariance at the knots
+        ##    C_ks = m x N cross-covariance, knots x sites (ns_cov_cross)
+        ##    diag_K = N-vector, the exact marginal variances at the sites
+        self.N      = C_ks.shape[1]
+        self.m      = C_ks.shape[0]
+        chol_kk     = scipy.linalg.cholesky(C_kk, lower = True)
+        self.A      = scipy.linalg.solve_triangular(chol_kk, C_ks, lower = True)
+        # floor the nugget: the low-rank part can round to slightly above diag_K
+        self.D      = np.maximum(diag_K - np.sum(self.A**2, axis = 0), 1e-8 * diag_K)
+        M           = np.eye(self.m) + (self.A / self.D) @ self.A.T
+        self.chol_M = scipy.linalg.cholesky(M, lower = True)
+        self.logdet = np.sum(np.log(self.D)) + 2*np.sum(np.log(np.diag(self.chol_M)))
+        # K^{-1} = D^{-1} - G^T G,  G = L_M^{-1} A D^{-1}  (m x N)
+        self.G      = scipy.linalg.solve_triangular(self.chol_M, self.A / self.D, lower = True)
+
+    def logpdf(self, z):
+        # log N(z; 0, A^T A + D), O(N m); z can be N x T (one log-density per column)
+        zD = z / site_col(self.D, z)
+        v  = scipy.linalg.solve_triangular(self.chol_M, self.A @ zD, lower = True)
+        return -0.5 * (self.N * np.log(2*np.pi) + self.logdet + np.sum(z * zD, axis = 0) - np.sum(v**2, axis = 0))
+
+    def precision_dot(self, z):
+        return z / self.D - self.G.T @ (self.G @ z)
+
+    def precision_column(self, i):
+        # O(N m)
+        q_i     = -self.G.T @ self.G[:,i]
+        q_i[i] += 1/self.D[i]
+        return q_i
+
+    def precision_diagonal(self):
+        return 1/self.D - np.sum(self.G**2, axis = 0)
+
+    def rvs(self, random_state = None):
+        # unconditional draw: z = A^T w + sqrt(D) e,  w ~ N(0, I_m), e ~ N(0, I_N)
+        random_state = np.random.mtrand._rand if random_state is None else random_state
+        w = random_state.standard_normal(self.m)
+        return self.A.T @ w + np.sqrt(self.D) * random_state.standard_normal(self.N)
+
+    def conditional_rvs(self, z, obs_idx, random_state = None):
+        # draw the sites outside obs_idx given z[obs_idx], O(N m^2):
+        #   w | z_obs ~ N(P^{-1} A_o D_o^{-1} z_o, P^{-1}),  P = I + A_o D_o^{-1} A_o^T
+        #   z_new     = A_new^T w + sqrt(D_new) e
+        random_state = np.random.mtrand._rand if random_state is None else random_state
+        new_idx = np.setdiff1d(np.arange(self.N), obs_idx)
+        A_o     = self.A[:, obs_idx]
+        chol_P  = scipy.linalg.cholesky(np.eye(self.m) + (A_o / self.D[obs_idx]) @ A_o.T, lower = True)
+        mean_w  = scipy.linalg.cho_solve((chol_P, True), A_o @ (z[obs_idx] / self.D[obs_idx]))
+        w       = mean_w + scipy.linalg.solve_triangular(chol_P.T, random_state.standard_normal(self.m), lower = False)
+        z_new   = np.array(z, dtype = 'float64')
+        z_new[new_idx] = self.A[:, new_idx].T @ w + np.sqrt(self.D[new_idx]) * random_state.standard_normal(len(new_idx))
+        return z_new
+## -------------------------------------------------------------------------- ##
+
+# Greedy (largest degree first) colouring of the graph of the precision of Z_field: the
+# sites of one colour share no edge, so one vectorised pass can move them all. The zero
+# pattern of a Vecchia Q only depends on the ordering and the neighbour sets, so the
+# colouring holds for every range; a dense precision gives one colour per site.
+#   for idx in precision_coloring(Z_field): ...
+def precision_coloring(Z_field):
+    Q = Z_field.precision_graph()
+    if Q is None:
+        return [np.array([i]) for i in range(Z_field.N)]
+    Q      = scipy.sparse.csr_matrix(Q)
+    colour = np.full(Q.shape[0], -1)
+    for i in np.argsort(-np.diff(Q.indptr), kind = 'stable'):
+        used = set(colour[Q.indices[Q.indptr[i]:Q.indptr[i+1]]])
+        c    = 0
+        while c in used:
+            c += 1
+        colour[i] = c
+    return [np.flatnonzero(colour == c) for c in range(colour.max() + 1)]
+
+## -------------------------------------------------------------------------- ##
+##               Node-local shared memory across MPI ranks
+## -------------------------------------------------------------------------- ##
+# MPI-3 shared-memory windows (MPI.Win.Allocate_shared): one copy of an array per
+# node, written by the node's first rank, with zero-copy numpy views on every other
+# rank of the node. Only for arrays that are read-only once written.
+#   node_shared = NodeShared(comm)
+#   Y           = node_shared.array(np.load('Y.npy', mmap_mode = 'r')) # every rank knows the shape
+#   Y_init      = node_shared.bcast(Y_init)                            # Y_init only on rank 0
+class NodeShared:
+    def __init__(self, comm):
+        from mpi4py import MPI
+        self.MPI         = MPI
+        self.comm        = comm
+        self.node_comm   = comm.Split_type(MPI.COMM_TYPE_SHARED, key = comm.Get_rank())
+        self.node_rank   = self.node_comm.Get_rank()
+        # the first rank of every node; rank 0 of comm is also rank 0 here
+        self.leader_comm = comm.Split(0 if self.node_rank == 0 else MPI.UNDEFINED, key = comm.Get_rank())
+        self.windows     = [] # keep the windows (and so the memory) alive
+        self.slots       = {} # double buffers for bcast_Z_field
+
+    def allocate(self, shape, dtype = 'float64'):
+        # collective over the node: every rank must call it, in the same order
+        dtype  = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize if self.node_rank == 0 else 0
+        win    = self.MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm = self.node_comm)
+        buf, _ = win.Shared_query(0)
+        self.windows.append(win)
+        return np.ndarray(buffer = buf, dtype = dtype, shape = shape)
+
+    def fill(self, arr, data = None, root = 0):
+        # write data, held by comm's root (rank 0) only, into every node's copy of arr
+        if self.node_rank == 0:
+            if self.comm.Get_rank() == root:
+                arr[...] = data
+            self.leader_comm.Bcast(arr, root = root)
+        self.node_comm.Barrier()
+        return arr
+
+    def array(self, data):
+        # node-shared copy of data; every rank passes something with the right shape
+        # and dtype (e.g. np.load(..., mmap_mode = 'r')), only the first rank reads it
+        arr = self.allocate(data.shape, data.dtype)
+        if self.node_rank == 0:
+            arr[...] = data
+        self.node_comm.Barrier()
+        return arr
+
+    def bcast(self, data, root = 0):
+        # node-shared copy of data that only lives on comm's root (rank 0)
+        shape, dtype = self.comm.bcast((data.shape, data.dtype) if self.comm.Get_rank() == root else None, 
+                                       root = root)
+        return self.fill(self.allocate(shape, dtype), data, root = root)
+
+    def slot(self, name, shape, dtype, avoid = None):
+        # one of two persistent buffers for name, whichever is not avoid (the one in use)
+        if name not in self.slots:
+            self.slots[name] = [self.allocate(shape, dtype), self.allocate(shape, dtype)]
+        return self.slots[name][1] if self.slots[name][0] is avoid else self.slots[name][0]
+
+# Build (construct and factorise) the field once, on root, and share it with all ranks.
+# The numpy arrays (the factor, Q, ...) go through the buffer interface (comm.Bcast) and
+# only the small remainder is pickled; each rank then does its own triangular solves.
+# With shared = NodeShared(comm) the arrays go to node-local shared memory instead,
+# alternating between two buffers so that the current field is never overwritten.
+# Returns None on every rank if K is not positive definite.
+def bcast_Z_field(comm, make_field, K = None, root = 0, shared = None, current = None):
+    ## Arguments:
+    ##    comm = mpi4py communicator
+    ##    make_field = GaussianField, or any callable K -> field object
+    ##    K = N x N covariance matrix (or whatever make_field takes), only needed on root
+    ##    shared = None --> NodeShared(comm), one copy of the field per node (root = 0)
+    ##    current = None --> the field in use, whose shared buffers must be kept
+    rank  = comm.Get_rank()
+    field = None
+    if rank == root:
+        try:
+            field = make_field(K)
+        except np.linalg.LinAlgError:
+            field = None
+    if comm.Get_size() == 1 and shared is None:
+        return field
+
+    if rank == root and field is not None:
+        arrays = {name: np.ascontiguousarray(value) for name, value in vars(field).items() 
+                                                    if isinstance(value, np.ndarray)}
+        shell  = copy.copy(field)
+        for name, value in arrays.items():
+            setattr(shell, name, (value.shape, value.dtype))
+    else:
+        arrays, shell = {}, None
+    shell = comm.bcast(shell, root = root)
+    if shell is None:
+        return None
+
+    names = sorted(name for name, value in vars(shell).items() if isinstance(value, tuple))
+    for name in names:
+        shape, dtype = getattr(shell, name)
+        if shared is None:
+            buf = arrays[name] if rank == root else np.empty(shape, dtype = dtype)
+            comm.Bcast(buf, root = root)
+        else:
+            buf = shared.slot(name, shape, dtype, avoid = getattr(current, name, None))
+            shared.fill(buf, arrays.get(name), root = root)
+        setattr(shell, name, buf)
+    return shell
+## -------------------------------------------------------------------------- ##
+
 #########################################################################################
 # Write my own covariance function ######################################################
 #########################################################################################
@@ -260,6 +752,11 @@ def wendland_weights_fun(d, theta, k=0, dimension=2, derivative=0):
     # theta: the range where the basis value is non-zero, i.e. [0, theta]
     # dimension: dimension of locations 
     # k: smoothness of the function at zero.
+    res = wendland_basis(d, theta, k, dimension, derivative)
+    return res/np.sum(res)
+
+# Wendland basis function before normalisation
+def wendland_basis(d, theta, k=0, dimension=2, derivative=0):
     if(isinstance(d, (int, np.int64, float))): 
         d=np.array([d])      
     d = d/theta
@@ -275,7 +772,55 @@ def wendland_weights_fun(d, theta, k=0, dimension=2, derivative=0):
                                             (6*l**2+36*l+45) * d**2 + (15*l+45) * d + 15), 0)
     if (k>3):
         sys.exit("k must be less than 4")
-    return res/np.sum(res)
+    return res
+
+# Basis (weight) matrix between all sites and all knots at once
+def weight_matrix(sites_xy, knots_xy, basis = 'gaussian', radius = None, bandwidth = 1, cutoff = True,
+                  wendland_k = 0, sparse = False, tol = None):
+    ## Arguments:
+    ##    sites_xy = N x 2 matrix of coordinates (stations or a plotting grid)
+    ##    knots_xy = k x 2 matrix of knot coordinates
+    ##    basis = 'gaussian' --> weights_fun, or 'wendland' --> wendland_weights_fun
+    ##    radius = scalar or k-vector: cutoff radius (gaussian) or support (wendland)
+    ##    bandwidth = 1 --> h of the Gaussian smoothing kernel
+    ##    cutoff = True --> zero the Gaussian weights beyond radius
+    ##    wendland_k = 0 --> smoothness of the Wendland basis
+    ##    sparse = False --> return a scipy.sparse CSR matrix instead of a dense one
+    ##    tol = None --> zero the normalised weights below tol (then renormalise), so that
+    ##                   every knot has a bounded support, as with cutoff but relative
+    ## Each row is normalised to sum to one, same as weights_fun/wendland_weights_fun
+    d = distance.cdist(sites_xy, knots_xy) # N x k
+    if basis == 'gaussian':
+        W = np.exp(-d**2/(2*bandwidth))
+        if cutoff:
+            W[d > radius] = 0
+    elif basis == 'wendland':
+        W = wendland_basis(d, radius, k = wendland_k)
+    else:
+        sys.exit("Please specify a valid basis (gaussian or wendland).")
+    W /= np.sum(W, axis = 1, keepdims = True)
+    if tol is not None:
+        W[W < tol] = 0
+        W /= np.sum(W, axis = 1, keepdims = True)
+    if sparse:
+        return scipy.sparse.csr_matrix(W)
+    return W
+
+# Sparse Wendland mixing of the knot-level stable variables
+# Each knot only reaches the sites within its radius, so keep the Wendland weights
+# column-compressed (scipy.sparse.csc_matrix) and, when only knot i moves, update
+# R_vec = W @ exp(S_log) on knot i's support instead of redoing the Ns x k product
+def knot_support(W_csc, i):
+    # sites within knot i's support, and their weights from knot i
+    start, end = W_csc.indptr[i], W_csc.indptr[i+1]
+    return W_csc.indices[start:end], W_csc.data[start:end]
+
+def update_R_vec(R_vec, W_csc, i, S_log_new_i, S_log_old_i):
+    # IN PLACE: R_vec += W[:, i] * (exp(s_new) - exp(s_old)), only on knot i's support
+    # returns the sites that changed
+    sites, w = knot_support(W_csc, i)
+    R_vec[sites] += w * (np.exp(S_log_new_i) - np.exp(S_log_old_i))
+    return sites
 
 # generate levy random samples
 def rlevy(n, m = 0, s = 1):
@@ -341,14 +886,34 @@ def rhalft(nu, mu=0, sigma=1):
     return mu + np.abs(scipy.stats.t.rvs(nu, 0, sigma))
 
 # transformation to standard Pareto
-def norm_to_stdPareto(Z):
-    pNorm = scipy.stats.norm.cdf(x = Z)
-    return(scipy.stats.pareto.ppf(q = pNorm, b = 1))
-norm_to_stdPareto_vec = np.vectorize(norm_to_stdPareto)
-def stdPareto_to_Norm(W):
-    pPareto = scipy.stats.pareto.cdf(x = W, b = 1)
-    return(scipy.stats.norm.ppf(q = pPareto))
-stdPareto_to_Norm_vec = np.vectorize(stdPareto_to_Norm)
+# closed form on whole arrays, no scalar scipy.stats calls:
+#   W = g(Z)    = 1/(1 - Phi(Z)) = 1/Phi(-Z)
+#   Z = ginv(W) = Phi^{-1}(1 - 1/W) = -Phi^{-1}(1/W)
+# out = optional preallocated array to write the result into
+def norm_to_stdPareto(Z, out = None):
+    if out is None:
+        return 1/sc.ndtr(np.negative(Z))
+    sc.ndtr(np.negative(Z), out = out)
+    return np.reciprocal(out, out = out)
+def log_norm_to_stdPareto(Z, out = None):
+    # log g(Z) = -log Phi(-Z), stays accurate far into the upper tail
+    if out is None:
+        return -sc.log_ndtr(np.negative(Z))
+    sc.log_ndtr(np.negative(Z), out = out)
+    return np.negative(out, out = out)
+def stdPareto_to_Norm(W, out = None):
+    # W <= 1 has Pareto cdf 0, i.e. Z = -inf
+    if out is None:
+        return -sc.ndtri(np.minimum(1/np.asarray(W, dtype = 'float64'), 1.0))
+    np.divide(1.0, W, out = out)
+    np.minimum(out, 1.0, out = out)
+    sc.ndtri(out, out = out)
+    return np.negative(out, out = out)
+def dlog_norm_to_stdPareto(Z):
+    # d/dZ log g(Z) = phi(Z)/Phi(-Z), the inverse Mills ratio
+    return np.exp(kernels.norm_logpdf(Z) - sc.log_ndtr(np.negative(Z)))
+norm_to_stdPareto_vec = norm_to_stdPareto
+stdPareto_to_Norm_vec = stdPareto_to_Norm
 
 # transformation to shifted Pareto
 def norm_to_Pareto1(z):
@@ -371,12 +936,67 @@ if norm_pareto == 'standard':
 
     g = norm_to_stdPareto_vec
     ginv = stdPareto_to_Norm_vec
+    dlog_g = dlog_norm_to_stdPareto
 
     dRW = RW_inte.dRW_standard_Pareto_nugget_vec
     pRW = RW_inte.pRW_standard_Pareto_nugget_vec
     qRW = RW_inte.qRW_standard_Pareto_nugget_vec
 
 
+# %% NN emulator of qRW
+# Feed-forward network (emulate_qRW.py) mapping (p, phi, gamma, tau) to log qRW:
+#   Ws, bs, acts = load_qRW_NN('./data/qRW_LHS_5000000/')
+#   X            = qRW_NN(Ws, bs, acts, pY, phi_vec, gamma_vec, tau)
+
+def relu_np(x): # changes x IN PLACE! faster than return x * (x > 0)
+    np.maximum(x, 0, x)
+
+def identity(x):
+    pass
+
+# the output is 1D if X is 1D
+#               2D if X is 2D
+def NNqRW_predict(Ws, bs, activations, X):
+    Z = X
+    for W, b, activation in zip(Ws, bs, activations):
+        Z = Z @ W + b
+        activation(Z)
+    return np.exp(Z)
+
+# emulated qRW, with the exact qRW where p >= 0.995 (outside the training range)
+def qRW_NN(Ws, bs, acts,
+           p, phi, gamma, tau):
+    Ns     = len(p)
+    inputs = np.column_stack((p, 
+                              phi,
+                              gamma, 
+                              np.full((Ns,),tau)))
+    emul_idx = np.where(inputs[:,0]  < 0.995)[0]
+    ni_idx   = np.where(inputs[:,0] >= 0.995)[0]
+    outputs  = np.full((Ns,), fill_value = np.nan)
+    outputs[emul_idx] = NNqRW_predict(Ws, bs, acts, inputs[emul_idx]).ravel()
+    outputs[ni_idx]   = qRW(inputs[ni_idx,0], inputs[ni_idx,1], inputs[ni_idx,2], tau)
+    return outputs
+
+# qRW_NN with the call of qRW (any broadcastable shapes, scalar tau), to use in its place
+def make_qRW_NN(emulator):
+    Ws, bs, acts = emulator
+    def qRW_emulated(p, phi, gamma, tau):
+        p, phi, gamma = np.broadcast_arrays(p, phi, gamma)
+        return qRW_NN(Ws, bs, acts, p.ravel(), phi.ravel(), gamma.ravel(), tau).reshape(p.shape)
+    return qRW_emulated
+
+# weights, biases and activations of the emulator saved in modelfolder
+def load_qRW_NN(modelfolder):
+    with open(modelfolder+'qRW_NN_Ws.pkl',   'rb') as f:
+        Ws = pickle.load(f)
+    with open(modelfolder+'qRW_NN_bs.pkl',   'rb') as f:
+        bs = pickle.load(f)
+    with open(modelfolder+'qRW_NN_acts.pkl', 'rb') as f:
+        acts_str = pickle.load(f)
+        acts     = [relu_np if act_str == 'relu' else identity for act_str in acts_str]
+    return Ws, bs, acts
+
 # %% Likelihood
 # Likelihood
 
@@ -391,19 +1011,498 @@ def Y_censored_ll_1t(Y, p, u_vec, scale_vec, shape_vec,         # marginal obser
     #   exceed_idx   = np.where(Y > u_vec)[0]
     #   If necessary, 
     #       dRW can be optimized too (by passing a dedicate argument for it)
+    #   for (Ns, Nt) arrays, all times at once, see Y_censored_ll_Nt
     if(isinstance(Y, (int, np.int64, float))): 
         Y = np.array([Y], dtype='float64')
     
     # log likelihood of the censored sites
-    censored_ll = scipy.stats.norm.logcdf((X[censored_idx] - X_star[censored_idx])/tau)
+    censored_ll = kernels.norm_logcdf((X[censored_idx] - X_star[censored_idx])/tau)
 
     # log likelihood of the exceedance sites
-    exceed_ll   = scipy.stats.norm.logpdf(X[exceed_idx], loc = X_star[exceed_idx], scale = tau) \
-                    + np.log(dCGP(Y[exceed_idx], p, u_vec[exceed_idx], scale_vec[exceed_idx], shape_vec[exceed_idx])) \
+    exceed_ll   = kernels.norm_logpdf(X[exceed_idx], loc = X_star[exceed_idx], scale = tau) \
+                    + kernels.cgp_logpdf(Y[exceed_idx], p, u_vec[exceed_idx], scale_vec[exceed_idx], shape_vec[exceed_idx]) \
                     - np.log(dX[exceed_idx])
 
     return np.sum(censored_ll) + np.sum(exceed_ll)
 
+# per-site contributions of Y_censored_ll_1t, at the sites idx only (default all)
+def Y_censored_ll_1t_sites(Y, p, u_vec, scale_vec, shape_vec,
+                           X, X_star, dX, tau, idx = None, marginal_ll = None):
+    # Note:
+    #   same terms as Y_censored_ll_1t, returned as a vector over idx instead of summed
+    #   sites are censored where Y <= u_vec (missing Y must already be imputed)
+    #   marginal_ll = Y_marginal_ll_1t(...), if cached; only the nugget terms are then evaluated
+    #   Y, X, X_star, dX can be (Ns, Nt), with per-site u_vec, scale_vec, shape_vec and a scalar
+    #   or per-time tau; missing Y (NaN) contribute 0
+    if idx is not None:
+        Y, u_vec, scale_vec, shape_vec = Y[idx], u_vec[idx], scale_vec[idx], shape_vec[idx]
+        X, X_star, dX                  = X[idx], X_star[idx], dX[idx]
+        marginal_ll                    = None if marginal_ll is None else marginal_ll[idx]
+    censored = Y <= site_col(u_vec, Y)
+    exceed   = Y >  site_col(u_vec, Y)
+    tau      = np.broadcast_to(tau, np.shape(Y))
+    ll       = np.zeros(np.shape(Y))
+
+    # log likelihood of the censored sites
+    ll[censored] = kernels.norm_logcdf((X[censored] - X_star[censored])/tau[censored])
+
+    # log likelihood of the exceedance sites
+    if marginal_ll is None:
+        marginal_ll = Y_marginal_ll_1t(Y, p, u_vec, scale_vec, shape_vec, dX)
+    ll[exceed]   = kernels.norm_logpdf(X[exceed], loc = X_star[exceed], scale = tau[exceed]) + marginal_ll[exceed]
+    return ll
+
+# Y_censored_ll_1t at all times at once, one log-likelihood per column
+def Y_censored_ll_Nt(Y, p, u_vec, scale_vec, shape_vec, X, X_star, dX, tau):
+    # Note:
+    #   Y, X, X_star, dX are (Ns, Nt), u_vec, scale_vec, shape_vec per site, tau scalar or per time
+    #   the censoring masks are taken per column, and missing Y (NaN) contribute 0
+    return np.sum(Y_censored_ll_1t_sites(Y, p, u_vec, scale_vec, shape_vec, X, X_star, dX, tau), axis = 0)
+
+# Y_censored_ll_1t with X and dX from the emulator only (no integration anywhere, also for
+# p >= 0.995): X = NN(pY), dX = dRW(X) = 1 / (d qRW / dp) by a central difference of the
+# NN in p. A cheap surrogate, e.g. for screening proposals (delayed acceptance)
+#   emulator = (Ws, bs, acts)
+def Y_censored_ll_1t_NN(Y, p, u_vec, scale_vec, shape_vec,
+                        phi_vec, gamma_vec, tau, X_star, emulator,
+                        censored_idx, exceed_idx, dp = 1e-5):
+    Ws, bs, acts = emulator
+    pY     = pCGP(Y, p, u_vec, scale_vec, shape_vec)
+    inputs = lambda pY: np.column_stack((pY, phi_vec, gamma_vec, np.full(len(pY), tau)))
+    X      = NNqRW_predict(Ws, bs, acts, inputs(pY)).ravel()
+    pY_lo  = np.clip(pY - dp/2, 0.0, 1.0 - dp)
+    dX     = dp / (NNqRW_predict(Ws, bs, acts, inputs(pY_lo + dp)).ravel() - NNqRW_predict(Ws, bs, acts, inputs(pY_lo)).ravel())
+    return Y_censored_ll_1t(Y, p, u_vec, scale_vec, shape_vec,
+                            None, None, phi_vec, gamma_vec, tau,
+                            X, X_star, dX, censored_idx, exceed_idx)
+
+# d Y_censored_ll_1t / d X_star, per site (gradient-based updates of log S and Z)
+#   censored: -phi(a)/(Phi(a) tau), a = (X - X_star)/tau;  exceedance: (X - X_star)/tau^2
+def Y_censored_ll_1t_grad_X_star(Y, u_vec, X, X_star, tau):
+    a    = (X - X_star)/tau
+    grad = np.zeros(np.shape(Y))
+    censored, exceed = Y <= u_vec, Y > u_vec
+    grad[censored] = -np.exp(kernels.norm_logpdf(a[censored]) - kernels.norm_logcdf(a[censored]))/tau
+    grad[exceed]   = a[exceed]/tau
+    return grad
+
+# the exceedance terms of Y_censored_ll_1t that do not involve X_star (0 at censored sites):
+#   log dCGP(Y) - log dX
+# they only change with Y (imputation), the GP parameters, phi and tau
+def Y_marginal_ll_1t(Y, p, u_vec, scale_vec, shape_vec, dX):
+    # Y, dX can be (Ns, Nt), as in Y_censored_ll_1t_sites
+    shape  = np.shape(Y)
+    exceed = Y > site_col(u_vec, Y)
+    ll     = np.zeros(shape)
+    ll[exceed] = kernels.cgp_logpdf(Y[exceed], p, np.broadcast_to(site_col(u_vec, Y), shape)[exceed],
+                                    np.broadcast_to(site_col(scale_vec, Y), shape)[exceed],
+                                    np.broadcast_to(site_col(shape_vec, Y), shape)[exceed]) \
+                    - np.log(dX[exceed])
+    return ll
+
+# Likelihood state of one time replicate: keeps the per-site contributions so that a
+# proposal touching a few sites (e.g. a knot's Wendland support) only recomputes those.
+#   llik_state = CensoredLikelihood1t(Y_1t, p, u_vec, Scale_vec, Shape_vec, X_1t, X_star_1t, dX_1t, tau)
+#   llik_state.propose(support_idx, X_star_1t_proposal) # total log-likelihood under the proposal
+#   llik_state.commit()                                  # if accepted, otherwise llik_state.rollback()
+# The marginal terms (Y_marginal_ll_1t) are cached: after Y, the GP parameters, phi or
+# tau change, call llik_state.set_marginal(...) with the new values.
+class CensoredLikelihood1t:
+    def __init__(self, Y, p, u_vec, scale_vec, shape_vec, X, X_star, dX, tau):
+        self.set_marginal(Y, p, u_vec, scale_vec, shape_vec, X, X_star, dX, tau)
+
+    def set_marginal(self, Y, p, u_vec, scale_vec, shape_vec, X, X_star, dX, tau):
+        self.Y, self.p, self.u_vec         = Y, p, u_vec
+        self.scale_vec, self.shape_vec     = scale_vec, shape_vec
+        self.X, self.dX                    = X, dX
+        self.tau                           = tau
+        self.marginal_ll = Y_marginal_ll_1t(Y, p, u_vec, scale_vec, shape_vec, dX)
+        self.ll_sites    = Y_censored_ll_1t_sites(Y, p, u_vec, scale_vec, shape_vec, X, X_star, dX, tau,
+                                                  marginal_ll = self.marginal_ll)
+        self.total       = np.sum(self.ll_sites)
+        self.rollback()
+
+    def propose(self, idx, X_star, X = None, dX = None, scale_vec = None, shape_vec = None):
+        # X_star = the full proposed X_star vector; only the sites idx differ from the current one
+        # X, dX = the full proposed vectors, if they change at idx too (phi on part of the sites):
+        #         the marginal terms at idx are then recomputed as well
+        # scale_vec, shape_vec = the proposed GP parameters, for those marginal terms
+        scale_vec = self.scale_vec if scale_vec is None else scale_vec
+        shape_vec = self.shape_vec if shape_vec is None else shape_vec
+        self.proposal_idx = idx
+        if X is None:
+            self.proposal_marginal = None
+            self.proposal_ll       = Y_censored_ll_1t_sites(self.Y, self.p, self.u_vec, self.scale_vec, self.shape_vec,
+                                                            self.X, X_star, self.dX, self.tau, idx = idx,
+                                                            marginal_ll = self.marginal_ll)
+        else:
+            self.proposal_marginal = Y_marginal_ll_1t(self.Y[idx], self.p, self.u_vec[idx], scale_vec[idx], shape_vec[idx], dX[idx])
+            self.proposal_ll       = Y_censored_ll_1t_sites(self.Y[idx], self.p, self.u_vec[idx], scale_vec[idx], shape_vec[idx],
+                                                            X[idx], X_star[idx], dX[idx], self.tau,
+                                                            marginal_ll = self.proposal_marginal)
+        return self.total + np.sum(self.proposal_ll) - np.sum(self.ll_sites[idx])
+
+    def commit(self, keep = None):
+        # keep = boolean mask over the proposed sites, None --> all of them
+        if keep is None:
+            self.ll_sites[self.proposal_idx] = self.proposal_ll
+            if self.proposal_marginal is not None:
+                self.marginal_ll[self.proposal_idx] = self.proposal_marginal
+        else:
+            self.ll_sites[self.proposal_idx[keep]] = self.proposal_ll[keep]
+        self.total = np.sum(self.ll_sites)
+        self.rollback()
+
+    def rollback(self):
+        self.proposal_idx, self.proposal_ll, self.proposal_marginal = None, None, None
+
+## -------------------------------------------------------------------------- ##
+##               Per-time sampler state with declared dependencies
+## -------------------------------------------------------------------------- ##
+# The current values of one time replicate and everything derived from them:
+#   S_log --> R_vec --> X_star        Z     --> gZ --> X_star, Qz, Z_ll
+#   phi   --> X, dX, X_star           tau   --> X, dX
+#   range --> Z_field --> Qz, Z_ll    Y, X, dX --> cached marginal likelihood terms
+#   scale_vec, shape_vec --> X, dX at the exceedance sites
+# Each propose_*() recomputes the stale quantities only, into preallocated proposal
+# buffers, and returns the proposed log-likelihood (data + Gaussian term); commit()
+# copies the touched entries into the current arrays, rollback() restores the buffers.
+# The current arrays are updated in place, so references to them stay valid.
+#   llik_1t_proposal = state.propose_S(i, S_log_i)
+#   state.commit() if accepted else state.rollback()
+class CopulaState1t:
+    buffers = ('S_log', 'R_vec', 'Z', 'gZ', 'phi_vec', 'X_star', 'X', 'dX', 'scale_vec', 'shape_vec')
+
+    def __init__(self, Y, p, u_vec, scale_vec, shape_vec, gamma_vec, W_csc,
+                 S_log, Z, phi_vec, tau, Z_field, qRW_fun = None):
+        ## Arguments:
+        ##    Y, p, u_vec, scale_vec, shape_vec = marginal observation (imputed) and GP parameters at this time
+        ##    gamma_vec = bar{gamma} at the sites
+        ##    W_csc = Ns x k Wendland weight matrix, scipy.sparse.csc_matrix
+        ##    S_log, Z, phi_vec, tau, Z_field = current values (Z_field: GaussianField or another engine)
+        ##    qRW_fun = None --> qRW; e.g. make_qRW_NN(emulator) for the emulated likelihood
+        self.Y, self.p, self.u_vec       = Y, p, u_vec
+        self.gamma_vec, self.W_csc       = gamma_vec, W_csc
+        self.censored_idx = np.where(Y <= u_vec)[0]
+        self.exceed_idx   = np.where(Y  > u_vec)[0]
+
+        self.scale_vec = np.array(scale_vec, dtype = 'float64')
+        self.shape_vec = np.array(shape_vec, dtype = 'float64')
+
+        self.S_log   = np.array(S_log, dtype = 'float64')
+        self.Z       = np.array(Z, dtype = 'float64')
+        self.phi_vec = np.array(phi_vec, dtype = 'float64')
+        self.tau     = tau
+        self.Z_field = Z_field
+        self.R_vec   = W_csc @ np.exp(self.S_log)
+        self.gZ      = g(self.Z)
+        self.X_star  = (self.R_vec ** self.phi_vec) * self.gZ
+        self.qRW     = qRW if qRW_fun is None else qRW_fun
+        self.X       = self.qRW(pCGP(Y, p, u_vec, scale_vec, shape_vec), self.phi_vec, gamma_vec, tau)
+        self.dX      = dRW(self.X, self.phi_vec, gamma_vec, tau)
+        self.proposal = {name: getattr(self, name).copy() for name in self.buffers}
+
+        self.llik_sites = CensoredLikelihood1t(Y, p, u_vec, self.scale_vec, self.shape_vec, self.X, self.X_star, self.dX, tau)
+        self.Z_ll       = Z_field.logpdf(self.Z)
+        self.Qz         = None # K^{-1} Z, built on the first Z move after Z_field changes
+        self.Q_diag     = None # diag(K^{-1}), likewise
+        self.pending    = None
+        self.batch      = None # propose_phi_batch arrays, until select_phi
+
+    @property
+    def llik(self):
+        return self.llik_sites.total + self.Z_ll
+
+    def _propose(self, kind, touched, llik, **extra):
+        # touched = {buffer name: index written}
+        self.pending = (kind, touched, extra)
+        return llik
+
+    def use_qRW(self, qRW_fun):
+        # switch between the exact and the emulated qRW: X, dX and the likelihood are recomputed
+        self.rollback()
+        self.qRW      = qRW_fun
+        self.X[:]     = self.qRW(pCGP(self.Y, self.p, self.u_vec, self.scale_vec, self.shape_vec), self.phi_vec, self.gamma_vec, self.tau)
+        self.dX[:]    = dRW(self.X, self.phi_vec, self.gamma_vec, self.tau)
+        self.proposal['X'][:], self.proposal['dX'][:] = self.X, self.dX
+        self.llik_sites.set_marginal(self.Y, self.p, self.u_vec, self.scale_vec, self.shape_vec,
+                                     self.X, self.X_star, self.dX, self.tau)
+
+    def propose_S(self, i, S_log_i):
+        P = self.proposal
+        P['S_log'][i] = S_log_i
+        sites = update_R_vec(P['R_vec'], self.W_csc, i, S_log_i, self.S_log[i]) # knot i's support only
+        P['X_star'][sites] = (P['R_vec'][sites] ** self.phi_vec[sites]) * self.gZ[sites]
+        llik = self.llik_sites.propose(sites, P['X_star']) + self.Z_ll
+        return self._propose('S', {'S_log': i, 'R_vec': sites, 'X_star': sites}, llik)
+
+    def propose_S_block(self, idx, S_log_idx):
+        # the knots idx at once (block updates): the union of their supports is recomputed
+        P = self.proposal
+        sites = np.unique(np.concatenate([update_R_vec(P['R_vec'], self.W_csc, i, S_log_i, self.S_log[i])
+                                          for i, S_log_i in zip(idx, S_log_idx)]))
+        P['S_log'][idx]    = S_log_idx
+        P['X_star'][sites] = (P['R_vec'][sites] ** self.phi_vec[sites]) * self.gZ[sites]
+        llik = self.llik_sites.propose(sites, P['X_star']) + self.Z_ll
+        return self._propose('S', {'S_log': idx, 'R_vec': sites, 'X_star': sites}, llik)
+
+    def propose_GP(self, scale_vec, shape_vec, sites = None):
+        # marginal GP parameters: pCGP(Y) = p at the censored sites whatever the scale and shape,
+        # so X, dX and the likelihood are recomputed at the exceedance sites only
+        ## Arguments:
+        ##    sites = None --> all sites take the proposed scale and shape; e.g. the observed sites,
+        ##            so that imputed Y (drawn under the current scale and shape) keep theirs
+        P     = self.proposal
+        sites = np.arange(len(self.Y)) if sites is None else sites
+        ex    = np.intersect1d(self.exceed_idx, sites)
+        P['scale_vec'][sites], P['shape_vec'][sites] = scale_vec[sites], shape_vec[sites]
+        P['X'][ex]  = self.qRW(pCGP(self.Y[ex], self.p, self.u_vec[ex], P['scale_vec'][ex], P['shape_vec'][ex]),
+                               self.phi_vec[ex], self.gamma_vec[ex], self.tau)
+        P['dX'][ex] = dRW(P['X'][ex], self.phi_vec[ex], self.gamma_vec[ex], self.tau)
+        llik = self.llik_sites.propose(ex, self.X_star, P['X'], P['dX'], P['scale_vec'], P['shape_vec']) + self.Z_ll
+        return self._propose('GP', {'scale_vec': sites, 'shape_vec': sites, 'X': ex, 'dX': ex}, llik)
+
+    def propose_Z(self, i, Z_i):
+        P = self.proposal
+        if self.Qz is None:
+            self.Qz = self.Z_field.precision_dot(self.Z)
+        dZ    = Z_i - self.Z[i]
+        Q_col = self.Z_field.precision_column(i)
+        Z_ll  = self.Z_ll + self.Z_field.delta_logpdf(self.Qz, i, dZ, Q_col)
+        P['Z'][i]      = Z_i
+        P['gZ'][i]     = g(Z_i)
+        P['X_star'][i] = (self.R_vec[i] ** self.phi_vec[i]) * P['gZ'][i]
+        llik = self.llik_sites.propose(np.array([i]), P['X_star']) + Z_ll
+        return self._propose('Z', {'Z': i, 'gZ': i, 'X_star': i}, llik, i = i, dZ = dZ, Q_col = Q_col, Z_ll = Z_ll)
+
+    def propose_Z_sites(self, idx, Z_idx):
+        # one-site moves at all sites idx at once, idx conditionally independent (one colour of
+        # precision_coloring): returns the per-site log acceptance ratios, for commit(accept)
+        P = self.proposal
+        if self.Qz is None:
+            self.Qz = self.Z_field.precision_dot(self.Z)
+        if self.Q_diag is None:
+            self.Q_diag = self.Z_field.precision_diagonal()
+        dZ    = Z_idx - self.Z[idx]
+        dZ_ll = -(dZ * self.Qz[idx] + 0.5 * dZ**2 * self.Q_diag[idx])
+        P['Z'][idx]      = Z_idx
+        P['gZ'][idx]     = g(Z_idx)
+        P['X_star'][idx] = (self.R_vec[idx] ** self.phi_vec[idx]) * P['gZ'][idx]
+        self.llik_sites.propose(idx, P['X_star'])
+        self._propose('Z_sites', {'Z': idx, 'gZ': idx, 'X_star': idx}, None, idx = idx, dZ = dZ, dZ_ll = dZ_ll)
+        return self.llik_sites.proposal_ll - self.llik_sites.ll_sites[idx] + dZ_ll
+
+    def propose_Z_vector(self, Z):
+        # the whole of Z at once (elliptical slice sampling): returns the data log-likelihood
+        # only, the Gaussian term of the accepted Z is computed on commit()
+        P = self.proposal
+        P['Z'][:]      = Z
+        P['gZ'][:]     = g(P['Z'])
+        P['X_star'][:] = (self.R_vec ** self.phi_vec) * P['gZ']
+        llik = self.llik_sites.propose(np.arange(len(Z)), P['X_star'])
+        return self._propose('Z_vector', {'Z': slice(None), 'gZ': slice(None), 'X_star': slice(None)}, llik)
+
+    def propose_S_Z(self, S_log, Z):
+        # all of log S and Z jointly (gradient-based moves): returns the log-likelihood
+        P = self.proposal
+        P['S_log'][:]  = S_log
+        P['R_vec'][:]  = self.W_csc @ np.exp(P['S_log'])
+        P['Z'][:]      = Z
+        P['gZ'][:]     = g(P['Z'])
+        P['X_star'][:] = (P['R_vec'] ** self.phi_vec) * P['gZ']
+        Z_ll = self.Z_field.logpdf(P['Z'])
+        llik = self.llik_sites.propose(np.arange(len(Z)), P['X_star']) + Z_ll
+        touched = {name: slice(None) for name in ('S_log', 'R_vec', 'Z', 'gZ', 'X_star')}
+        return self._propose('S_Z', touched, llik, Z_ll = Z_ll)
+
+    def llik_NN(self, emulator, phi_vec = None, tau = None):
+        # emulated log-likelihood (Y_censored_ll_1t_NN) at the current values, or with phi_vec
+        # or tau replaced; touches nothing, so no commit()/rollback()
+        X_star  = self.X_star if phi_vec is None else (self.R_vec ** phi_vec) * self.gZ
+        phi_vec = self.phi_vec if phi_vec is None else phi_vec
+        tau     = self.tau if tau is None else tau
+        return Y_censored_ll_1t_NN(self.Y, self.p, self.u_vec, self.scale_vec, self.shape_vec,
+                                   phi_vec, self.gamma_vec, tau, X_star, emulator,
+                                   self.censored_idx, self.exceed_idx) + self.Z_ll
+
+    def grad_S_Z(self, proposal = False):
+        # gradient of the log-likelihood (data + Gaussian term) in (log S, Z), at the current
+        # values or, with proposal = True, at the pending propose_S_Z:
+        #   d X_star / d log S_j = X_star phi W[:,j] S_j / R_vec,  d X_star / d Z = X_star dlog_g(Z)
+        values = self.proposal if proposal else vars(self)
+        S_log, R_vec, Z, X_star = values['S_log'], values['R_vec'], values['Z'], values['X_star']
+        d_X_star = Y_censored_ll_1t_grad_X_star(self.Y, self.u_vec, self.X, X_star, self.tau) * X_star
+        d_R_vec  = np.divide(d_X_star * self.phi_vec, R_vec, out = np.zeros(len(R_vec)), where = R_vec > 0)
+        grad_S   = (self.W_csc.T @ d_R_vec) * np.exp(S_log)
+        if not proposal and self.Qz is None:
+            self.Qz = self.Z_field.precision_dot(self.Z)
+        grad_Z   = d_X_star * dlog_g(Z) - (self.Qz if not proposal else self.Z_field.precision_dot(Z))
+        return grad_S, grad_Z
+
+    def _propose_marginal(self, kind, phi_vec, tau):
+        # phi or tau: X, dX (and with phi, X_star) change everywhere
+        P = self.proposal
+        P['X'][:]  = self.qRW(pCGP(self.Y, self.p, self.u_vec, self.scale_vec, self.shape_vec), phi_vec, self.gamma_vec, tau)
+        P['dX'][:] = dRW(P['X'], phi_vec, self.gamma_vec, tau)
+        X_star     = P['X_star'] if kind == 'phi' else self.X_star
+        llik = Y_censored_ll_1t(self.Y, self.p, self.u_vec, self.scale_vec, self.shape_vec,
+                                None, None, phi_vec, self.gamma_vec, tau,
+                                P['X'], X_star, P['dX'], self.censored_idx, self.exceed_idx) + self.Z_ll
+        touched = {'X': slice(None), 'dX': slice(None)}
+        if kind == 'phi':
+            touched.update({'phi_vec': slice(None), 'X_star': slice(None)})
+        return self._propose(kind, touched, llik, tau = tau)
+
+    def propose_phi(self, phi_vec, sites = None):
+        # sites = None --> everywhere; otherwise the sites where phi_vec can differ from the current
+        # one (e.g. the supports of a block's knots under truncated Gaussian weights): X, dX,
+        # X_star and the likelihood are recomputed at those sites only
+        P = self.proposal
+        if sites is None:
+            P['phi_vec'][:] = phi_vec
+            P['X_star'][:]  = (self.R_vec ** phi_vec) * self.gZ
+            return self._propose_marginal('phi', P['phi_vec'], self.tau)
+        P['phi_vec'][sites] = phi_vec[sites]
+        P['X'][sites]       = self.qRW(pCGP(self.Y[sites], self.p, self.u_vec[sites], self.scale_vec[sites], self.shape_vec[sites]),
+                                       phi_vec[sites], self.gamma_vec[sites], self.tau)
+        P['dX'][sites]      = dRW(P['X'][sites], phi_vec[sites], self.gamma_vec[sites], self.tau)
+        P['X_star'][sites]  = (self.R_vec[sites] ** phi_vec[sites]) * self.gZ[sites]
+        llik = self.llik_sites.propose(sites, P['X_star'], P['X'], P['dX']) + self.Z_ll
+        return self._propose('phi_sites', {name: sites for name in ('phi_vec', 'X', 'dX', 'X_star')}, llik)
+
+    def propose_tau(self, tau):
+        return self._propose_marginal('tau', self.phi_vec, tau)
+
+    def propose_phi_batch(self, phi_mat):
+        # M phi_vec proposals (M x Ns) evaluated together, as the columns of Ns x M arrays
+        # (one qRW/dRW pass); returns the M log-likelihoods. select_phi(j) then makes
+        # proposal j the pending one, for commit() or rollback()
+        phi    = np.asarray(phi_mat, dtype = 'float64').T
+        pY     = pCGP(self.Y, self.p, self.u_vec, self.scale_vec, self.shape_vec)
+        X      = self.qRW(np.broadcast_to(pY[:,None], phi.shape), phi, self.gamma_vec[:,None], self.tau)
+        dX     = dRW(X, phi, self.gamma_vec[:,None], self.tau)
+        X_star = (self.R_vec[:,None] ** phi) * self.gZ[:,None]
+        llik   = Y_censored_ll_Nt(np.broadcast_to(self.Y[:,None], phi.shape), self.p, self.u_vec, self.scale_vec, self.shape_vec,
+                                  X, X_star, dX, self.tau) + self.Z_ll
+        self.batch = (phi, X, X_star, dX, llik)
+        return llik
+
+    def select_phi(self, j):
+        phi, X, X_star, dX, llik = self.batch
+        P = self.proposal
+        P['phi_vec'][:], P['X'][:], P['X_star'][:], P['dX'][:] = phi[:,j], X[:,j], X_star[:,j], dX[:,j]
+        self.batch = None
+        touched = {'phi_vec': slice(None), 'X': slice(None), 'dX': slice(None), 'X_star': slice(None)}
+        return self._propose('phi', touched, llik[j], tau = self.tau)
+
+    def propose_range(self, Z_field):
+        # Z_field = the field under the proposed range (from bcast_Z_field)
+        Z_ll = Z_field.logpdf(self.Z)
+        return self._propose('range', {}, self.llik_sites.total + Z_ll, Z_field = Z_field, Z_ll = Z_ll)
+
+    def commit(self, accept = None):
+        # accept = boolean mask over the sites of propose_Z_sites (the others are rolled back)
+        kind, touched, extra = self.pending
+        if kind == 'Z_sites':
+            rejected = extra['idx'][~accept]
+            for name in touched:
+                self.proposal[name][rejected] = getattr(self, name)[rejected]
+            touched = {name: extra['idx'][accept] for name in touched}
+        for name, idx in touched.items():
+            getattr(self, name)[idx] = self.proposal[name][idx]
+        if kind in ('S', 'Z', 'Z_vector', 'S_Z', 'phi_sites', 'GP'):
+            self.llik_sites.commit()
+        if kind == 'Z':
+            self.Z_field.update_Qz(self.Qz, extra['i'], extra['dZ'], extra['Q_col'])
+            self.Z_ll = extra['Z_ll']
+        if kind == 'Z_vector':
+            self.Z_ll, self.Qz = self.Z_field.logpdf(self.Z), None
+        if kind == 'S_Z':
+            self.Z_ll, self.Qz = extra['Z_ll'], None
+        if kind == 'Z_sites':
+            self.llik_sites.commit(accept)
+            dZ = np.zeros(len(self.Z))
+            dZ[touched['Z']] = extra['dZ'][accept]
+            self.Qz   += self.Z_field.precision_dot(dZ)
+            self.Z_ll += np.sum(extra['dZ_ll'][accept])
+        if kind in ('phi', 'tau'):
+            self.tau = extra['tau']
+            self.llik_sites.set_marginal(self.Y, self.p, self.u_vec, self.scale_vec, self.shape_vec,
+                                         self.X, self.X_star, self.dX, self.tau)
+        if kind == 'range':
+            self.Z_field, self.Z_ll, self.Qz, self.Q_diag = extra['Z_field'], extra['Z_ll'], None, None
+        self.pending = None
+
+    def rollback(self):
+        if self.pending is None:
+            return
+        kind, touched, extra = self.pending
+        for name, idx in touched.items():
+            self.proposal[name][idx] = getattr(self, name)[idx]
+        self.llik_sites.rollback()
+        self.pending = None
+
+## -------------------------------------------------------------------------- ##
+##          Generalised Metropolis-Hastings with M proposals (Calderhead 2014)
+## -------------------------------------------------------------------------- ##
+# An auxiliary point z ~ N(x, Sigma) is drawn around the current state x, and M proposals
+# y_j ~ N(z, Sigma) around z. Given z the pool {x, y_1, ..., y_M} is exchangeable, so the
+# next state is drawn from the pool with probability proportional to the posterior.
+#   proposals  = gmh_proposals(current, idx, Sigma, M, random_generator)  # M x len(current)
+#   choice     = gmh_select(log_post, random_generator)  # log_post[0] is the current state
+#   if choice > 0: current = proposals[choice - 1]
+def gmh_proposals(current, idx, cov, M, random_generator):
+    ## Arguments:
+    ##    idx = the entries of current that are moved (a block), the others are kept
+    ##    cov = len(idx) x len(idx) proposal covariance, e.g. sigma_m_sq * Sigma_0
+    z_aux     = current[idx] + random_generator.multivariate_normal(np.zeros(len(idx)), cov)
+    proposals = np.tile(current, (M, 1))
+    proposals[:, idx] = z_aux + random_generator.multivariate_normal(np.zeros(len(idx)), cov, size = M)
+    return proposals
+
+def gmh_select(log_post, random_generator):
+    ## Arguments:
+    ##    log_post = (M+1)-vector of log posteriors, current state first; -inf/nan --> never chosen
+    log_post = np.asarray(log_post, dtype = 'float64')
+    log_post = np.where(np.isnan(log_post), -np.inf, log_post)
+    if not np.isfinite(np.max(log_post)):
+        return 0
+    weights = np.exp(log_post - np.max(log_post))
+    return random_generator.choice(len(weights), p = weights / np.sum(weights))
+## -------------------------------------------------------------------------- ##
+
+## -------------------------------------------------------------------------- ##
+##               Streaming moments for the proposal adaptation
+## -------------------------------------------------------------------------- ##
+# Welford's running mean and covariance of a sequence of d-vectors, O(d^2) per update
+# (O(d) with diagonal = True: variances only), without keeping the draws:
+#   moments = WelfordCovariance(d)
+#   moments.update(x)  # every iteration
+#   moments.cov        # same as np.cov of the draws since the last reset()
+class WelfordCovariance:
+    def __init__(self, d, diagonal = False):
+        self.d        = d
+        self.diagonal = diagonal
+        self.reset()
+
+    def reset(self):
+        self.n    = 0
+        self.mean = np.zeros(self.d)
+        self.M2   = np.zeros(self.d) if self.diagonal else np.zeros((self.d, self.d))
+
+    def update(self, x):
+        x      = np.asarray(x, dtype = 'float64').ravel()
+        self.n += 1
+        delta  = x - self.mean
+        self.mean += delta / self.n
+        self.M2   += delta * (x - self.mean) if self.diagonal else np.outer(delta, x - self.mean)
+
+    @property
+    def cov(self):
+        # sample covariance (ddof = 1), the variances with diagonal = True; NaN before 2 draws
+        return self.M2 / (self.n - 1) if self.n > 1 else np.full(self.M2.shape, np.nan)
+## -------------------------------------------------------------------------- ##
+
 # full conditional likelihood of smooth process X_star
 def X_star_conditional_ll_1t(X_star, R_vec, phi_vec, K, # original Pr(X_star | R_vec, phi_vec, K)
                              Z_vec):                    # things to facilitate computation
@@ -432,19 +1531,26 @@ def Y_censored_ll_1t_detail(Y, p, u_vec, scale_vec, shape_vec,         # margina
     #   exceed_idx   = np.where(Y > u_vec)[0]
     #   If necessary, 
     #       dRW can be optimized too (by passing a dedicate argument for it)
+    #   for (Ns, Nt) arrays, all times at once, see Y_censored_ll_Nt_detail
     if(isinstance(Y, (int, np.int64, float))): 
         Y = np.array([Y], dtype='float64')
     
     # log likelihood of the censored sites
-    censored_ll = scipy.stats.norm.logcdf((X[censored_idx] - X_star[censored_idx])/tau)
+    censored_ll = kernels.norm_logcdf((X[censored_idx] - X_star[censored_idx])/tau)
 
     # log likelihood of the exceedance sites
-    exceed_ll   = scipy.stats.norm.logpdf(X[exceed_idx], loc = X_star[exceed_idx], scale = tau) \
-                    + np.log(dCGP(Y[exceed_idx], p, u_vec[exceed_idx], scale_vec[exceed_idx], shape_vec[exceed_idx])) \
+    exceed_ll   = kernels.norm_logpdf(X[exceed_idx], loc = X_star[exceed_idx], scale = tau) \
+                    + kernels.cgp_logpdf(Y[exceed_idx], p, u_vec[exceed_idx], scale_vec[exceed_idx], shape_vec[exceed_idx]) \
                     - np.log(dX[exceed_idx])
 
     return (np.sum(censored_ll), np.sum(exceed_ll))
 
+# Y_censored_ll_1t_detail at all times at once, (censored, exceedance) sums per column
+def Y_censored_ll_Nt_detail(Y, p, u_vec, scale_vec, shape_vec, X, X_star, dX, tau):
+    ll_sites = Y_censored_ll_1t_sites(Y, p, u_vec, scale_vec, shape_vec, X, X_star, dX, tau)
+    censored = Y <= site_col(u_vec, Y)
+    return (np.sum(np.where(censored, ll_sites, 0), axis = 0), np.sum(np.where(censored, 0, ll_sites), axis = 0))
+
 # full conditional likelihood of smooth process X_star
 def X_star_conditional_ll_1t_detail(X_star, R_vec, phi_vec, K, # original Pr(X_star | R_vec, phi_vec, K)
                                     Z_vec):                    # things to facilitate computation